@@ -5,16 +5,34 @@ import requests
 import os
 import json
 import subprocess
+import threading
+import queue
+import time
+import random
+import hashlib
+import math
+import re
+import sys
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import resource
+from urllib.parse import urlparse
 from osgeo import gdal
 import shapely as geom
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+import pyogrio
 from pyproj import Transformer
 from os import path
 import traceback
 import glob
 import csv
+import sqlite3
+import gzip
+import struct
 
 #########################################
 #####                               #####
@@ -25,13 +43,620 @@ import csv
 #########################################
 
 parser = argparse.ArgumentParser(description='Tools to help in the process of geotransforming urban atlases.')
-parser.add_argument('--step', metavar='{download-inputs, allmaps-transform, warp-plates, mosaic-plates, create-xyz}', type=str, 
+parser.add_argument('--step', metavar='{download-inputs, allmaps-transform, warp-plates, mosaic-plates, create-xyz, pipeline, verify-transform, benchmark-dissolve}', type=str, 
                     help='steps to execute (default: download-inputs)', default='download-inputs', dest='step')
 parser.add_argument('--identifier', type=str, 
                     help='commonwealth id', dest='identifier')
+parser.add_argument('--download-workers', type=int, default=8,
+                    help='number of concurrent downloads (default: 8)', dest='downloadWorkers')
+parser.add_argument('--rate-limit', type=float, default=4,
+                    help='maximum requests per second to any one host, 0 to disable (default: 4)', dest='rateLimit')
+parser.add_argument('--retries', type=int, default=5,
+                    help='times to retry a failed request with exponential backoff (default: 5)', dest='retries')
+parser.add_argument('--annotations-url', type=str, default='https://annotations.allmaps.org',
+                    help='base URL of the Allmaps annotations server, e.g. a local stand-in for benchmarking', dest='annotationsURL')
+parser.add_argument('--curator-url', type=str, default='https://curator.digitalcommonwealth.org',
+                    help='base URL of the Digital Commonwealth curator API, e.g. a local stand-in for benchmarking', dest='curatorURL')
+parser.add_argument('--verify-images', action='store_true',
+                    help='re-hash downloaded images against their manifests instead of trusting size and modification time', dest='verifyImages')
+parser.add_argument('--allmaps-api-url', type=str, default='https://api.allmaps.org',
+                    help='base URL of the Allmaps API, e.g. a local stand-in for benchmarking', dest='allmapsAPIURL')
+parser.add_argument('--no-http-cache', action='store_true',
+                    help='always re-fetch Allmaps and Digital Commonwealth JSON instead of revalidating the copies in `tmp/cache/http`', dest='noHTTPCache')
+parser.add_argument('--source', type=str, choices=['master', 'iiif'], default='master',
+                    help='download full master TIFFs, or only the masked region of each map at the scale needed for --max-zoom through the IIIF Image API (default: master)', dest='source')
+parser.add_argument('--max-zoom', type=int, default=20,
+                    help='highest zoom level of the XYZ tileset (default: 20)', dest='maxZoom')
+parser.add_argument('--transform-engine', type=str, choices=['native', 'allmaps'], default='allmaps',
+                    help='transform resource masks in-process, or with the `allmaps transform` CLI (default: allmaps, until native masks are checked against recorded CLI output)', dest='transformEngine')
+parser.add_argument('--transformation-type', type=str, choices=['polynomial', 'thinPlateSpline'], default=None,
+                    help="transformation for every map (default: each annotation's own, otherwise polynomial)", dest='transformationType')
+parser.add_argument('--polynomial-order', type=int, choices=[1, 2, 3], default=None,
+                    help="polynomial order for every map (default: each annotation's own, otherwise 1)", dest='polynomialOrder')
+parser.add_argument('--max-offset-ratio', type=float, default=0,
+                    help='add midpoints to mask edges whose transformed midpoint strays further than this ratio of the edge length (default: 0, off)', dest='maxOffsetRatio')
+parser.add_argument('--max-depth', type=int, default=0,
+                    help='times a mask edge may be split by --max-offset-ratio (default: 0, off)', dest='maxDepth')
+parser.add_argument('--repair-masks', type=str, choices=['none', 'make-valid', 'buffer'], default='none',
+                    help='repair invalid masks with `make_valid` or `buffer(0)` instead of reporting them (default: none)', dest='repairMasks')
+parser.add_argument('--precision', type=float, default=0.0001,
+                    help='grid size in degrees that `plates.geojson` coordinates are snapped to, 0 to keep full precision (default: 0.0001)', dest='precision')
+parser.add_argument('--simplify', type=float, default=0,
+                    help='topology-preserving simplification tolerance in degrees for `plates.geojson` (default: 0, off)', dest='simplify')
+parser.add_argument('--footprint-formats', type=lambda v: v.split(','), default=['geojson'],
+                    help='comma-separated footprint formats to write next to `plates.geojson`: fgb, parquet (default: geojson only)', dest='footprintFormats')
+parser.add_argument('--dissolve-workers', type=int, default=os.cpu_count(),
+                    help='processes used to dissolve plates that do not form a clean coverage (default: all cores)', dest='dissolveWorkers')
+parser.add_argument('--benchmark-copies', type=int, default=4,
+                    help='largest multiple of the atlas plates timed by `benchmark-dissolve` (default: 4)', dest='benchmarkCopies')
+parser.add_argument('--reference-dir', type=str, default='./tmp/annotations/transformed-cli/',
+                    help='recorded `allmaps transform resource-mask` output for the `verify-transform` step', dest='referenceDir')
+parser.add_argument('--transform-tolerance', type=float, default=0.1,
+                    help='largest distance in meters allowed between native and CLI masks (default: 0.1, one warped pixel)', dest='transformTolerance')
+parser.add_argument('--transform-workers', type=int, default=4,
+                    help='plates transformed at once in the `pipeline` step (default: 4)', dest='transformWorkers')
+parser.add_argument('--warp-workers', type=int, default=1,
+                    help='plates warped at once in the `pipeline` step (default: 1)', dest='warpWorkers')
+parser.add_argument('--queue-size', type=int, default=4,
+                    help='plates that may wait between `pipeline` stages (default: 4)', dest='queueSize')
+parser.add_argument('--warp-profile', type=str, choices=['legacy', 'cog-zstd', 'cog-deflate', 'cog-jpeg'], default='legacy',
+                    help='how warped plates are written: LZW GeoTIFF with an alpha band, or a tiled COG with overviews and a 1-bit mask (default: legacy)', dest='warpProfile')
+parser.add_argument('--tile-aligned', action='store_true',
+                    help='warp plates onto the pixel grid of `--max-zoom` tiles, so those tiles need no second resampling', dest='tileAligned')
+parser.add_argument('--warp-transformation', type=str, choices=['polynomial', 'annotation'], default='polynomial',
+                    help='warp every plate with a first order polynomial, or with the transformation of its annotation (including thin plate spline) like the masks (default: polynomial)', dest='warpTransformation')
+parser.add_argument('--error-threshold', type=float, default=None,
+                    help="error in pixels allowed for GDAL's approximate transformer, 0 for exact (default: GDAL's 0.125)", dest='errorThreshold')
+parser.add_argument('--max-gcps', type=int, default=0,
+                    help='GCPs kept for a thin plate spline warp, spread over the image; 0 keeps all (default: 0)', dest='maxGCPs')
+parser.add_argument('--memory-budget', type=int, default=0,
+                    help='MB of memory shared by all concurrent warps, split into GDAL block cache and warp buffers; very large plates are warped in windows (default: 0, GDAL defaults)', dest='memoryBudget')
+parser.add_argument('--seamlines', action='store_true',
+                    help='clip each plate in `mosaic-plates` to the part not covered by plates drawn over it, so every pixel is read from one plate', dest='seamlines')
+parser.add_argument('--materialize', action='store_true',
+                    help='also write the mosaic to `tmp/mosaic.tif`, a COG with overviews that `create-xyz` tiles from instead of the VRT', dest='materialize')
+parser.add_argument('--tiler', type=str, choices=['native', 'gdal2tiles'], default='gdal2tiles',
+                    help='cut tiles in `create-xyz` with gdal2tiles, or with the built-in tiler, which only renders tiles over plates and resumes an interrupted run; without --pyramid it reads the plates once per zoom (default: gdal2tiles)', dest='tiler')
+parser.add_argument('--tile-workers', type=int, default=os.cpu_count(),
+                    help='processes cutting tiles in `create-xyz` (default: number of CPUs)', dest='tileWorkers')
+parser.add_argument('--pyramid', action='store_true',
+                    help='with `--tiler native`, render only `--max-zoom` from the plates and build each lower zoom from the four tiles under it', dest='pyramid')
+parser.add_argument('--pyramid-resampling', type=str, choices=['average', 'nearest'], default='average',
+                    help='how `--pyramid` reduces four tiles to one (default: average)', dest='pyramidResampling')
+parser.add_argument('--retile', action='store_true',
+                    help='with `--tiler native`, cut again only the tiles over plates that changed since the last `create-xyz`, and remove tiles left empty', dest='retile')
+parser.add_argument('--map-ids', type=lambda v: v.split(','), default=None,
+                    help='comma-separated map IDs to `--retile`, instead of the plates found to have changed', dest='mapIds')
+parser.add_argument('--tile-archive', type=str, choices=['none', 'pmtiles', 'mbtiles'], default='none',
+                    help='with `--tiler native`, write tiles into `output/tiles.pmtiles` or `output/tiles.mbtiles`, storing identical tiles once, instead of `output/tiles/{z}/{x}/{y}.png` (default: none)', dest='tileArchive')
+parser.add_argument('--tile-format', type=str, choices=['png', 'png8', 'webp', 'webp-lossy', 'auto-jpeg', 'auto-webp'], default='png',
+                    help='how the native tiler encodes tiles: RGBA PNG, palette PNG, lossless or lossy WebP, or JPEG / lossy WebP for tiles without transparency and PNG / lossless WebP for the rest; auto-jpeg needs --tile-archive (default: png)', dest='tileFormat')
+parser.add_argument('--tile-quality', type=int, default=85,
+                    help='quality of lossy JPEG and WebP tiles (default: 85)', dest='tileQuality')
+parser.add_argument('--encode-workers', type=int, default=os.cpu_count(),
+                    help='threads encoding tiles in the native tiler (default: number of CPUs)', dest='encodeWorkers')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='plates warped at once in separate processes in the `warp-plates` step, or mosaic windows read at once with `--materialize` (default: 1)', dest='jobs')
 
 args = parser.parse_args()
 
+# an XYZ folder has one extension, so JPEG and PNG tiles can only be mixed in an archive
+
+if args.tileFormat == 'auto-jpeg' and args.tileArchive == 'none':
+    parser.error('--tile-format auto-jpeg needs --tile-archive pmtiles or mbtiles')
+
+#########################################
+#####                               #####
+#####   `DownloadEngine` shared by  #####
+#####    every step that talks to   #####
+#####         the network           #####
+#####                               #####
+#########################################
+
+CHUNK_SIZE = 1024 * 1024
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class IncompleteDownload(Exception):
+    pass
+
+def readJSONFile(file):
+    with open(file) as f:
+        return json.load(f)
+
+def writeJSONFile(file, data):
+    with open(file+'.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(file+'.tmp', file)
+
+def parseContentRange(contentRange):
+    # e.g. `bytes 1000-4999/5000`
+    span, total = contentRange.split(' ')[1].split('/')
+    return int(span.split('-')[0]), (int(total) if total != '*' else None)
+
+def hashFile(file, sha256=None):
+    sha256 = sha256 or hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256
+
+def writeManifest(file, url, size, sha256, etag=None):
+
+    # record size, hash and mtime in a sidecar `{file}.manifest.json`
+    # so later runs can trust the file without reading it
+
+    writeJSONFile(file+'.manifest.json', {
+        'url': url,
+        'size': size,
+        'sha256': sha256,
+        'etag': etag,
+        'mtime_ns': os.stat(file).st_mtime_ns
+    })
+
+def isVerified(file, deep=False):
+    if not os.path.isfile(file) or not os.path.isfile(file+'.manifest.json'):
+        return False
+    manifest = readJSONFile(file+'.manifest.json')
+    stat = os.stat(file)
+    if stat.st_size != manifest['size']:
+        return False
+    if deep:
+        return hashFile(file).hexdigest() == manifest['sha256']
+    return stat.st_mtime_ns == manifest['mtime_ns']
+
+class HostRateLimiter:
+
+    # space requests to each host evenly so that
+    # concurrent workers don't hammer a single server
+
+    def __init__(self, perSecond):
+        self.interval = 1.0 / perSecond if perSecond > 0 else 0
+        self.nextSlot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.nextSlot.get(host, now))
+            self.nextSlot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class DownloadEngine:
+
+    # one pooled keep-alive session, bounded concurrency,
+    # retries with exponential backoff and a per-host rate limit
+
+    def __init__(self, workers=8, rateLimit=4, retries=5, timeout=60, cacheDir=None):
+        self.workers = max(1, workers)
+        self.cacheDir = cacheDir
+        self.cacheStats = {'fetched': 0, 'revalidated': 0}
+        self.statsLock = threading.Lock()
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+        self.retries = retries
+        self.timeout = timeout
+        self.limiter = HostRateLimiter(rateLimit)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def backoff(self, attempt, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return float(response.headers['Retry-After'])
+        return min(60, 2 ** attempt) + random.uniform(0, 1)
+
+    def request(self, url, stream=False, headers=None, method='GET'):
+        for attempt in range(self.retries + 1):
+            self.limiter.wait(url)
+            try:
+                response = self.session.request(method, url, stream=stream, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                print(f'🔁 {e.__class__.__name__} on {url}, retrying in {delay:.1f}s...')
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                delay = self.backoff(attempt, response)
+                print(f'🔁 HTTP {response.status_code} on {url}, retrying in {delay:.1f}s...')
+                response.close()
+            time.sleep(delay)
+
+    def getJSON(self, url):
+
+        # JSON responses are kept in `cacheDir` with their ETag and
+        # Last-Modified values; later requests are conditional
+        # and a 304 is answered from disk
+
+        if not self.cacheDir:
+            return self.request(url).json()
+        cacheFile = os.path.join(self.cacheDir, hashlib.sha256(url.encode()).hexdigest()+'.json')
+        cached = readJSONFile(cacheFile) if os.path.isfile(cacheFile) else None
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('lastModified'):
+            headers['If-Modified-Since'] = cached['lastModified']
+        response = self.request(url, headers=headers)
+        if response.status_code == 304 and cached:
+            self.count('revalidated')
+            return cached['body']
+        body = response.json()
+        self.count('fetched')
+        if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+            writeJSONFile(cacheFile, {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'lastModified': response.headers.get('Last-Modified'),
+                'body': body
+            })
+        return body
+
+    def count(self, stat):
+        with self.statsLock:
+            self.cacheStats[stat] += 1
+
+    def printCacheStats(self):
+        if self.cacheDir:
+            print(f"🗄️  JSON requests: {self.cacheStats['fetched']} fetched, {self.cacheStats['revalidated']} unchanged (304) served from cache")
+
+    def download(self, url, dest):
+
+        # stream the body into `{dest}.part`, hashing as it goes;
+        # after an interruption resume with an HTTP Range request
+        # guarded by If-Range, so a changed file starts over.
+        # only a complete, length-checked file is renamed into place
+
+        part = dest+'.part'
+        partInfoFile = part+'.json'
+        for attempt in range(self.retries + 1):
+            partInfo = readJSONFile(partInfoFile) if os.path.isfile(part) and os.path.isfile(partInfoFile) else None
+            offset = 0
+            headers = {}
+            if partInfo and partInfo.get('url') == url and partInfo.get('validator'):
+                offset = os.path.getsize(part)
+                if offset == partInfo.get('size'):
+                    # every byte arrived before the run stopped, a Range
+                    # request from here would only be answered with a 416
+                    print(f'⏯️  {part} is already complete, finishing it')
+                    return self.finishPart(url, dest, hashFile(part), partInfo.get('etag'))
+                headers = {'Range': f'bytes={offset}-', 'If-Range': partInfo['validator']}
+            try:
+                with self.request(url, stream=True, headers=headers) as response:
+                    sha256 = hashlib.sha256()
+                    if response.status_code == 206 and offset:
+                        start, total = parseContentRange(response.headers.get('Content-Range'))
+                        if start != offset:
+                            raise IncompleteDownload(f'server resumed {url} at byte {start}, expected {offset}')
+                        print(f'⏯️  Resuming {dest} at {offset/2**20:.1f} MiB')
+                        hashFile(part, sha256)
+                        mode = 'ab'
+                    else:
+                        offset = 0
+                        length = response.headers.get('Content-Length')
+                        total = int(length) if length and length.isdigit() else None
+                        mode = 'wb'
+                    etag = response.headers.get('ETag')
+                    lastModified = response.headers.get('Last-Modified')
+                    validator = etag if etag and not etag.startswith('W/') else lastModified
+                    writeJSONFile(partInfoFile, {'url': url, 'validator': validator, 'etag': etag, 'size': total})
+                    with open(part, mode) as fd:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            fd.write(chunk)
+                            sha256.update(chunk)
+                        fd.flush()
+                        os.fsync(fd.fileno())
+                size = os.path.getsize(part)
+                if total is not None and size != total:
+                    raise IncompleteDownload(f'got {size} of {total} bytes for {url}')
+                return self.finishPart(url, dest, sha256, etag)
+            except requests.HTTPError as e:
+                # 416: the part no longer fits the remote file
+                # (e.g. it is longer), so throw it away and start over
+                if not offset or e.response is None or e.response.status_code != 416:
+                    raise
+                print(f'🗑️  {part} does not match the remote file, downloading it again...')
+                os.remove(part)
+                os.remove(partInfoFile)
+                return self.download(url, dest)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, IncompleteDownload) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                print(f'🔁 {e.__class__.__name__} while downloading {url}, resuming in {delay:.1f}s...')
+                time.sleep(delay)
+
+    def finishPart(self, url, dest, sha256, etag):
+        part = dest+'.part'
+        os.replace(part, dest)
+        writeManifest(dest, url, os.path.getsize(dest), sha256.hexdigest(), etag)
+        os.remove(part+'.json')
+        return dest
+
+    def adopt(self, url, dest):
+
+        # a file without a manifest predates them or was cut short;
+        # keep it only if its length matches what the server reports
+
+        response = self.request(url, method='HEAD')
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) == os.path.getsize(dest):
+            writeManifest(dest, url, int(length), hashFile(dest).hexdigest(), response.headers.get('ETag'))
+            return True
+        print(f'🗑️  {dest} does not match the remote file, downloading it again...')
+        os.remove(dest)
+        return False
+
+    def map(self, fn, items):
+
+        # run `fn` over `items` with at most `workers` in flight,
+        # returning results in the order of `items`
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(fn, items))
+
+def createEngine():
+    return DownloadEngine(workers=args.downloadWorkers, rateLimit=args.rateLimit, retries=args.retries,
+                          cacheDir=None if args.noHTTPCache else './tmp/cache/http')
+
+#########################################
+#####                               #####
+#####   `AnnotationStore` parses    #####
+#####    each annotation once for   #####
+#####       every later step        #####
+#####                               #####
+#########################################
+
+class PlateRecord:
+
+    # what the steps need from one annotation, with the
+    # GCPs already projected to EPSG:3857 as NumPy arrays
+
+    __slots__ = ('mapId', 'hash', 'gcpHash', 'imageId', 'commId', 'width', 'height',
+                 'transformation', 'pixels', 'geo', 'mask', 'stat')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    @classmethod
+    def fromAnnotation(cls, mapId, annotation, stat=None):
+        source = annotation['target']['source']
+        transformation = annotation['body'].get('transformation') or {}
+        pixels, geo = readGCPs(annotation)
+        return cls(
+            mapId=mapId,
+            hash=annotationHash(annotation),
+            gcpHash=hashJSON(annotation['body']['features']),
+            imageId=source['id'],
+            commId=source['partOf'][0]['id'][-9:] if source.get('partOf') else None,
+            width=source['width'],
+            height=source['height'],
+            transformation=[transformation.get('type'), (transformation.get('options') or {}).get('order')],
+            pixels=pixels,
+            geo=geo,
+            mask=parseResourceMask(annotation),
+            stat=stat
+        )
+
+    @classmethod
+    def fromRow(cls, row):
+        fields = dict(row)
+        for name in ['pixels', 'geo', 'mask']:
+            fields[name] = np.frombuffer(fields[name], dtype=np.float64).reshape(-1, 2)
+        fields['transformation'] = json.loads(fields['transformation'])
+        return cls(**fields)
+
+    def toRow(self):
+        row = {name: getattr(self, name) for name in self.__slots__}
+        for name in ['pixels', 'geo', 'mask']:
+            row[name] = np.ascontiguousarray(row[name], dtype=np.float64).tobytes()
+        row['transformation'] = json.dumps(row['transformation'])
+        return row
+
+class AnnotationStore:
+
+    # one row per map in `tmp/annotations.sqlite`, kept in step
+    # with `tmp/annotations/*.json`: a file is only parsed again
+    # when its size or mtime changed
+
+    def __init__(self, file='./tmp/annotations.sqlite', path='./tmp/annotations/'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS plates ({', '.join(PlateRecord.__slots__)}, PRIMARY KEY (mapId))")
+        self.records = {row['mapId']: PlateRecord.fromRow(row) for row in self.db.execute('SELECT * FROM plates')}
+        self.sync()
+
+    def statFile(self, mapId):
+        stat = os.stat(f'{self.path}{mapId}.json')
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+    def put(self, mapId, annotation):
+        record = PlateRecord.fromAnnotation(mapId, annotation, self.statFile(mapId))
+        row = record.toRow()
+        with self.lock:
+            self.db.execute(f"INSERT OR REPLACE INTO plates VALUES ({', '.join(':'+k for k in row)})", row)
+            self.db.commit()
+            self.records[mapId] = record
+        return record
+
+    def sync(self):
+        mapIds = {os.path.splitext(f)[0] for f in os.listdir(self.path) if f.endswith('.json') and not f.startswith('.')}
+        for mapId in sorted(mapIds):
+            record = self.records.get(mapId)
+            if record is None or record.stat != self.statFile(mapId):
+                try:
+                    self.put(mapId, readJSONFile(f'{self.path}{mapId}.json'))
+                except (ValueError, KeyError, IndexError, AttributeError, TypeError) as e:
+                    print(f'‼️   Could not read annotation {mapId}.json: {e!r}')
+        with self.lock:
+            for mapId in set(self.records) - mapIds:
+                self.db.execute('DELETE FROM plates WHERE mapId = ?', (mapId,))
+                del self.records[mapId]
+            self.db.commit()
+
+    def get(self, mapId):
+        return self.records.get(mapId)
+
+    def all(self):
+        return [self.records[mapId] for mapId in sorted(self.records)]
+
+storeLock = threading.Lock()
+store = None
+
+def annotationStore():
+
+    # opened once per process; workers forked by `--jobs`
+    # inherit the records already read by the parent
+
+    global store
+    with storeLock:
+        if store is None:
+            store = AnnotationStore()
+        return store
+
+#########################################
+#####                               #####
+#####    `saveAnnotation` writes    #####
+#####    an annotation only if it   #####
+#####    changed since last run     #####
+#####                               #####
+#########################################
+
+def hashJSON(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def annotationHash(annotation):
+    return hashJSON(annotation)
+
+def saveAnnotation(mapId, annotation):
+
+    # returns 'new', 'changed' or 'unchanged' and leaves
+    # unchanged files untouched so their mtime stays put
+
+    file = f'./tmp/annotations/{mapId}.json'
+    status = 'new'
+    if os.path.isfile(file):
+        try:
+            previous = readJSONFile(file)
+            status = 'unchanged' if annotationHash(previous) == annotationHash(annotation) else 'changed'
+        except ValueError:
+            status = 'changed'
+    if status != 'unchanged':
+
+        # open the store first, so its first sync doesn't read the new
+        # file too. an annotation it can't read is reported and left to
+        # the steps that use it, as `AnnotationStore.sync` does
+
+        records = annotationStore()
+        with open(file, 'w') as f:
+            json.dump(annotation, f)
+        try:
+            records.put(mapId, annotation)
+        except (ValueError, KeyError, IndexError, AttributeError, TypeError) as e:
+            print(f'‼️   Could not read annotation {mapId}.json: {e!r}')
+    return status
+
+def reportChanges(changes):
+
+    # print and save which annotations changed since the last run
+
+    counts = {s: sum(1 for v in changes.values() if v == s) for s in ['new', 'changed', 'unchanged']}
+    print(f"📝 Annotations: {counts['new']} new, {counts['changed']} changed, {counts['unchanged']} unchanged")
+    for mapId, status in changes.items():
+        if status == 'changed':
+            print(f'   ✏️  {mapId} changed since the last run')
+    with open('tmp/changed-annotations.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['allmapsMapID', 'status'])
+        for mapId, status in sorted(changes.items()):
+            writer.writerow([mapId, status])
+
+#########################################
+#####                               #####
+#####   `checkArtifact` reuses an   #####
+#####    artifact only if the       #####
+#####    inputs it was built from   #####
+#####        are unchanged          #####
+#####                               #####
+#########################################
+
+def checkArtifact(file, inputs):
+
+    # compare `inputs` (name → hash) with those recorded in
+    # `{file}.inputs.json` when `file` was built. returns whether
+    # it can be reused and why; a reuse is recorded straight away
+
+    record = file+'.inputs.json'
+    if not os.path.isfile(file):
+        return False, 'not built yet'
+    if not os.path.isfile(record):
+        return False, 'built before its inputs were recorded'
+    previous = readJSONFile(record)
+    changed = sorted(k for k in set(inputs) | set(previous['inputs']) if inputs.get(k) != previous['inputs'].get(k))
+    if changed:
+        return False, f"{', '.join(changed)} changed"
+    recordArtifact(file, inputs, 'inputs unchanged', reused=True)
+    return True, 'inputs unchanged'
+
+def recordArtifact(file, inputs, reason, reused=False):
+    writeJSONFile(file+'.inputs.json', {
+        'inputs': inputs,
+        'action': 'reused' if reused else 'built' if reason == 'not built yet' else 'rebuilt',
+        'reason': reason,
+        'checked': time.time()
+    })
+
+def discardArtifact(file):
+    for f in [file, file+'.inputs.json']:
+        if os.path.isfile(f):
+            os.remove(f)
+
+def artifactHash(file):
+
+    # what a downstream artifact depends on: the recorded
+    # inputs of `file`, or the file itself if it has none
+
+    if os.path.isfile(file+'.inputs.json'):
+        return hashJSON(readJSONFile(file+'.inputs.json')['inputs'])
+    return sourceHash(file)
+
+def sourceHash(file):
+
+    # the sha256 recorded when a source was downloaded,
+    # or its size and mtime if it came from elsewhere
+
+    if os.path.isfile(file+'.manifest.json'):
+        return readJSONFile(file+'.manifest.json')['sha256']
+    stat = os.stat(file)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+def reportArtifacts(since):
+
+    # gather every `*.inputs.json` into `tmp/artifacts.json`
+    # and summarize what was rebuilt or reused since `since`
+
+    report = {}
+    for record in sorted(glob.iglob('tmp/**/*.inputs.json', recursive=True)):
+        entry = readJSONFile(record)
+        report[record[:-len('.inputs.json')]] = {k: entry[k] for k in ['action', 'reason', 'checked']}
+    writeJSONFile('tmp/artifacts.json', report)
+    recent = {file: entry for file, entry in report.items() if entry['checked'] >= since}
+    counts = {a: sum(1 for entry in recent.values() if entry['action'] == a) for a in ['built', 'rebuilt', 'reused']}
+    print(f"♻️  Artifacts: {counts['built']} built, {counts['rebuilt']} rebuilt, {counts['reused']} reused (see `tmp/artifacts.json`)")
+    for file, entry in recent.items():
+        if entry['action'] == 'rebuilt':
+            print(f"   🔁 {file}: {entry['reason']}")
+
 #########################################
 #####                               #####
 #####    STEP 1: `downloadInputs`   #####
@@ -40,61 +665,350 @@ args = parser.parse_args()
 #####                               #####
 #########################################
 
-def downloadInputs(identifier):
+def downloadAnnotations(engine, identifier):
 
     # get Allmaps manifest as JSON
-    # create empty list to hold image filenames
 
-    allmapsManifest = requests.get(f'https://annotations.allmaps.org/?url=https://www.digitalcommonwealth.org/search/{identifier}/manifest.json').json()
+    allmapsManifest = engine.getJSON(f'{args.annotationsURL}/?url=https://www.digitalcommonwealth.org/search/{identifier}/manifest.json')
 
-    # download each map in the manifest
-    # and save as .json file
+    # the collection already holds every annotation in full,
+    # so split it into one .json file per map locally
+    # instead of requesting each `item['id']` again
 
     print(" ")
-    print(f"Beginning to download {len((allmapsManifest)['items'])} annotations...")
+    print(f"Splitting {len((allmapsManifest)['items'])} annotations...")
     print(" ")
+    changes = {}
     for item in allmapsManifest['items']:
         allmapsMapURL = item['id']
-        print(f'⤵️ Downloading annotation {allmapsMapURL}')
-        allmapsAnnotation = requests.get(allmapsMapURL, stream=True).json()
-        with open(f'./tmp/annotations/{allmapsMapURL[-16:]}.json', 'w') as f:
-            json.dump(allmapsAnnotation, f)
+        allmapsAnnotation = dict(item)
+        if '@context' in allmapsManifest and '@context' not in allmapsAnnotation:
+            allmapsAnnotation = {'@context': allmapsManifest['@context'], **allmapsAnnotation}
+        changes[allmapsMapURL[-16:]] = saveAnnotation(allmapsMapURL[-16:], allmapsAnnotation)
     
     print("✅   All annotations downloaded!")
+    reportChanges(changes)
+    return allmapsManifest['items']
 
-    # download any images not present in directory
+def collectImages(items):
 
-    for item in allmapsManifest["items"]:
+    # several maps can share one image, so
+    # map each image ID to its manifest and map IDs
+
+    images = {}
+    for item in items:
         imgManifest = item["target"]["source"]["id"]
         imgID = imgManifest.split("commonwealth:")[1][0:9]
-        imgURL=f"https://curator.digitalcommonwealth.org/api/filestreams/image/commonwealth:{imgID}?show_primary_url=true"      
-        imgFile = f'./tmp/img/{imgID}.tif'
-        if os.path.isfile(imgFile) == True:
-            print(f'⏭️ Skipping {imgFile}, already exists...')
-        else:
-            print(f'⤵️ Downloading image {imgManifest}')
-            imageRequest = requests.get(imgURL, stream=True)
-            response = imageRequest.json()
-            img = requests.get(response['file_set']['image_primary_url'])
-            with open(imgFile, 'wb') as fd:
-                for chunk in img.iter_content(chunk_size=128):
-                    fd.write(chunk)
+        images.setdefault(imgID, (imgManifest, []))[1].append(item['id'][-16:])
+    return images
 
-    print("✅   All images downloaded!")
+def downloadImage(engine, imgID, imgManifest):
+
+    # download an image unless a verified copy is present
+
+    imgURL=f"{args.curatorURL}/api/filestreams/image/commonwealth:{imgID}?show_primary_url=true"      
+    imgFile = f'./tmp/img/{imgID}.tif'
+    if isVerified(imgFile, deep=args.verifyImages):
+        print(f'⏭️ Skipping {imgFile}, already downloaded and verified...')
+        return
+    response = engine.getJSON(imgURL)
+    primaryURL = response['file_set']['image_primary_url']
+    if os.path.isfile(imgFile) and engine.adopt(primaryURL, imgFile):
+        print(f'⏭️ Skipping {imgFile}, matches the remote file...')
+        return
+    print(f'⤵️ Downloading image {imgManifest}')
+    engine.download(primaryURL, imgFile)
+    print(f'✔️  Downloaded {imgFile}')
+
+# resolution of a web mercator tile pixel at zoom 0
+
+WEB_MERCATOR_RESOLUTION = 2 * math.pi * 6378137 / 256
+
+def tileResolution(zoom):
+    return WEB_MERCATOR_RESOLUTION / 2 ** zoom
+
+def parseResourceMask(annotation):
+
+    # pixel vertices of the SVG resource mask
+
+    points = re.search(r'points="([^"]+)"', annotation['target']['selector']['value']).group(1)
+    return np.array([p.split(',') for p in points.split()], dtype=float)
+
+def readGCPs(annotation):
+
+    # pixel coordinates and EPSG:3857 coordinates of the GCPs
+
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    features = annotation['body']['features']
+    pixels = np.array([f['properties']['resourceCoords'] for f in features], dtype=float).reshape(-1, 2)
+    lon, lat = np.array([f['geometry']['coordinates'] for f in features], dtype=float).reshape(-1, 2).T
+    return pixels, np.column_stack(transformer.transform(lon, lat))
+
+def maskBounds(record):
+
+    # pixel bbox of the SVG resource mask, clamped to the image
+
+    x0, y0 = np.maximum(record.mask.min(axis=0), 0)
+    x1, y1 = np.minimum(record.mask.max(axis=0), [record.width, record.height])
+    return x0, y0, x1, y1
+
+def sourcePixelSize(record):
+
+    # size in EPSG:3857 units of one source pixel,
+    # from an affine fit of the GCPs
+
+    A = np.column_stack([record.pixels, np.ones(len(record.pixels))])
+    coeffs = np.linalg.lstsq(A, record.geo, rcond=None)[0]
+    return math.sqrt(abs(np.linalg.det(coeffs[:2])))
+
+def sourceRegion(record):
+
+    # IIIF region and size covering the mask
+    # at the scale needed for `--max-zoom`
+
+    padding = 16
+    width, height = record.width, record.height
+    x0, y0, x1, y1 = maskBounds(record)
+    x0, y0 = max(0, math.floor(x0) - padding), max(0, math.floor(y0) - padding)
+    x1, y1 = min(width, math.ceil(x1) + padding), min(height, math.ceil(y1) + padding)
+    scale = min(1, sourcePixelSize(record) / tileResolution(args.maxZoom))
+    return {'x': x0, 'y': y0, 'w': x1 - x0, 'h': y1 - y0, 'size': max(1, math.ceil((x1 - x0) * scale))}
+
+def downloadRegion(engine, mapId):
+
+    # fetch only the masked part of the image through the
+    # IIIF Image API the annotation references; the region is saved
+    # next to the image so `warpPlate` can shift the GCPs onto it
+
+    record = annotationStore().get(mapId)
+    service = record.imageId.rstrip('/')
+    region = sourceRegion(record)
+    imgFile = f'./tmp/img/{mapId}-region.tif'
+    regionFile = f'./tmp/img/{mapId}-region.json'
+    if isVerified(imgFile, deep=args.verifyImages) and os.path.isfile(regionFile) and readJSONFile(regionFile) == region:
+        print(f'⏭️ Skipping {imgFile}, already downloaded and verified...')
+        return
+    regionURL = f"{service}/{region['x']},{region['y']},{region['w']},{region['h']}/{region['size']},/0/default.tif"
+    print(f'⤵️ Downloading region {regionURL}')
+    engine.download(regionURL, imgFile)
+    writeJSONFile(regionFile, region)
+    print(f'✔️  Downloaded {imgFile}')
+
+def downloadSource(engine, imgID, imgManifest, mapIds):
+    if args.source == 'iiif':
+        for mapId in mapIds:
+            downloadRegion(engine, mapId)
+    else:
+        downloadImage(engine, imgID, imgManifest)
+
+def createTileset(engine):
     
-    # create template tileJSON file
+    # create template tileJSON file, preferring the copy
+    # that ships next to this script so it works offline
 
     print("Creating template `tileset.json` file...")
 
-    template = requests.get("https://raw.githubusercontent.com/bplmaps/atlascope-utilities/master/modern-workflow/template.json").json()
+    templateFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'template.json')
+    if os.path.isfile(templateFile):
+        template = json.load(open(templateFile))
+    else:
+        template = engine.getJSON("https://raw.githubusercontent.com/bplmaps/atlascope-utilities/master/modern-workflow/template.json")
     tileset = open('output/tileset.json', 'w+')
     tileset.write(json.dumps(template, indent=2))
     tileset.close()
 
     print("✅   Template `tileset.json` file created in `output` directory!")
+
+def downloadInputs(identifier):
+
+    engine = createEngine()
+    items = downloadAnnotations(engine, identifier)
+
+    # download any images not present in directory
+
+    images = collectImages(items)
+    print(f"Beginning to download {len(images)} images with {engine.workers} workers...")
+    engine.map(lambda imgID: downloadSource(engine, imgID, *images[imgID]), images)
+
+    print("✅   All images downloaded!")
+    engine.printCacheStats()
+    
+    createTileset(engine)
     print("You can now proceed to the `allmaps-transform` step.")
     print(" ")
 
+#########################################
+#####                               #####
+#####   native polynomial and TPS   #####
+#####    transforms matching the    #####
+#####       Allmaps CLI output      #####
+#####                               #####
+#########################################
+
+# terms used by polynomials of order 1, 2 and 3
+
+POLYNOMIAL_TERMS = {1: 3, 2: 6, 3: 10}
+
+def polynomialBasis(u, v):
+    return np.stack([np.ones_like(u), u, v, u*u, u*v, v*v, u**3, u*u*v, u*v*v, v**3], axis=-1)
+
+def tpsKernel(r2):
+
+    # U(r) = r² log r, written in terms of r²
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(r2 > 0, 0.5 * r2 * np.log(r2), 0)
+
+def transformationFor(record):
+
+    # `--transformation-type` and `--polynomial-order` win
+    # over the annotation's own transformation
+
+    kind, order = record.transformation
+    return args.transformationType or kind or 'polynomial', args.polynomialOrder or order or 1
+
+def fitTransform(pixels, geo, kind='polynomial', order=1):
+
+    # fit pixel → EPSG:3857 in normalized pixel coordinates:
+    # least squares for polynomials, exact interpolation for
+    # thin plate splines (kernel weights plus an affine part)
+
+    mean = pixels.mean(axis=0)
+    scale = np.abs(pixels - mean).max() or 1
+    geoMean = geo.mean(axis=0)
+    u = (pixels - mean) / scale
+    n = len(u)
+    poly = np.zeros((10, 2))
+    if kind == 'thinPlateSpline':
+        if n < 3:
+            raise ValueError(f'a thin plate spline needs at least 3 GCPs, got {n}')
+        K = tpsKernel(((u[:, None] - u[None]) ** 2).sum(axis=-1))
+        P = polynomialBasis(u[:, 0], u[:, 1])[:, :3]
+        L = np.block([[K, P], [P.T, np.zeros((3, 3))]])
+        solution = np.linalg.solve(L, np.vstack([geo - geoMean, np.zeros((3, 2))]))
+        weights = solution[:n]
+        poly[:3] = solution[n:]
+    else:
+        terms = POLYNOMIAL_TERMS[order]
+        if n < terms:
+            raise ValueError(f'a polynomial of order {order} needs at least {terms} GCPs, got {n}')
+        poly[:terms] = np.linalg.lstsq(polynomialBasis(u[:, 0], u[:, 1])[:, :terms], geo - geoMean, rcond=None)[0]
+        weights = np.zeros((0, 2))
+    return {'mean': mean, 'scale': scale, 'geoMean': geoMean, 'poly': poly, 'ctrl': u, 'weights': weights}
+
+def evaluateTransforms(fits, points, owner, chunk=65536):
+
+    # apply many fitted transforms at once: `points` are pixel
+    # coordinates and `owner` says which fit each one belongs to.
+    # control points are padded with zero weights so polynomial and
+    # TPS maps share one vectorized evaluation
+
+    means = np.array([f['mean'] for f in fits])
+    scales = np.array([f['scale'] for f in fits])
+    geoMeans = np.array([f['geoMean'] for f in fits])
+    polys = np.stack([f['poly'] for f in fits])
+    maxN = max(len(f['weights']) for f in fits)
+    ctrl = np.zeros((len(fits), maxN, 2))
+    weights = np.zeros((len(fits), maxN, 2))
+    for i, f in enumerate(fits):
+        ctrl[i, :len(f['weights'])] = f['ctrl'][:len(f['weights'])]
+        weights[i, :len(f['weights'])] = f['weights']
+
+    u = (points - means[owner]) / scales[owner][:, None]
+    out = np.einsum('vb,vbd->vd', polynomialBasis(u[:, 0], u[:, 1]), polys[owner]) + geoMeans[owner]
+    if maxN:
+        for start in range(0, len(u), chunk):
+            sl = slice(start, start + chunk)
+            r2 = ((u[sl, None, :] - ctrl[owner[sl]]) ** 2).sum(axis=-1)
+            out[sl] += np.einsum('vn,vnd->vd', tpsKernel(r2), weights[owner[sl]])
+    return out
+
+def transformRings(fits, rings, maxOffsetRatio=0, maxDepth=0):
+
+    # transform pixel rings (one per fit) to EPSG:3857, splitting
+    # edges whose transformed midpoint strays more than
+    # `maxOffsetRatio` of the edge length, up to `maxDepth` times.
+    # every vertex carries its position along the ring so the
+    # inserted midpoints can be put back in order with one sort
+
+    counts = np.array([len(r) for r in rings])
+    owner = np.repeat(np.arange(len(rings)), counts)
+    position = np.concatenate([np.arange(c, dtype=float) for c in counts])
+    points = np.vstack(rings)
+    geo = evaluateTransforms(fits, points, owner)
+
+    if maxOffsetRatio > 0 and maxDepth > 0:
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        nxt = starts + (position.astype(int) + 1) % np.repeat(counts, counts)
+        a, b = points, points[nxt]
+        aGeo, bGeo = geo, geo[nxt]
+        segOwner, segPosition, span = owner, position, np.ones(len(points))
+        inserted = []
+        for depth in range(maxDepth):
+            mid = (a + b) / 2
+            midGeo = evaluateTransforms(fits, mid, segOwner)
+            offset = np.linalg.norm(midGeo - (aGeo + bGeo) / 2, axis=1)
+            refine = offset > maxOffsetRatio * np.linalg.norm(bGeo - aGeo, axis=1)
+            if not refine.any():
+                break
+            half = span[refine] / 2
+            inserted.append((segOwner[refine], segPosition[refine] + half, midGeo[refine]))
+            a, b = np.vstack([a[refine], mid[refine]]), np.vstack([mid[refine], b[refine]])
+            aGeo, bGeo = np.vstack([aGeo[refine], midGeo[refine]]), np.vstack([midGeo[refine], bGeo[refine]])
+            segOwner = np.concatenate([segOwner[refine]] * 2)
+            segPosition = np.concatenate([segPosition[refine], segPosition[refine] + half])
+            span = np.concatenate([half, half])
+        for o, p, g in inserted:
+            owner, position, geo = np.concatenate([owner, o]), np.concatenate([position, p]), np.vstack([geo, g])
+        order = np.lexsort((position, owner))
+        owner, geo = owner[order], geo[order]
+
+    # close each ring and return it in lon/lat
+
+    transformer = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+    lonLat = np.column_stack(transformer.transform(geo[:, 0], geo[:, 1]))
+    split = np.split(lonLat, np.cumsum(np.bincount(owner, minlength=len(rings)))[:-1])
+    return [np.vstack([ring, ring[:1]]) for ring in split]
+
+def transformAnnotations(records):
+
+    # transform the resource masks of many annotations in one call;
+    # an annotation whose GCPs can't be fitted gets None
+
+    fits = []
+    for record in records:
+        try:
+            fits.append(fitTransform(record.pixels, record.geo, *transformationFor(record)))
+        except (ValueError, np.linalg.LinAlgError):
+            fits.append(None)
+    ok = [i for i, f in enumerate(fits) if f is not None]
+    rings = [None] * len(records)
+    if ok:
+        transformed = transformRings([fits[i] for i in ok], [records[i].mask for i in ok],
+                                     args.maxOffsetRatio, args.maxDepth)
+        for i, ring in zip(ok, transformed):
+            rings[i] = ring
+    return rings
+
+def fitAndTransform(record):
+
+    # like `transformAnnotations` for a single annotation,
+    # but raising when its GCPs can't be fitted
+
+    fit = fitTransform(record.pixels, record.geo, *transformationFor(record))
+    return transformRings([fit], [record.mask], args.maxOffsetRatio, args.maxDepth)[0]
+
+def writeMaskGeoJSON(file, ring, imageId):
+    with open(file, 'w') as f:
+        json.dump({
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "properties": {"imageId": imageId},
+                "geometry": {"type": "Polygon", "coordinates": [ring.tolist()]}
+            }]
+        }, f)
+
 #########################################
 #####                               #####
 #####   STEP 2: `allmapsTransform`  #####
@@ -103,18 +1017,12 @@ def downloadInputs(identifier):
 #####                               #####
 #########################################
 
-def allmapsTransform():
-    
-    # define path variables and lists for error handling
-
-    path = "./tmp/annotations/"
-    outPath = path+"transformed/"
-    invalid = []
-    invalidIDs = []
+def redownloadErrors(engine):
 
     # re-download annotations if error files exist
 
     errorFiles = ["tmp/errors/invalidMasks.csv", "tmp/errors/invalidPoints.csv"]
+    changes = {}
     for e in errorFiles:
         errorFileExists = os.path.isfile(e)
         if errorFileExists == True:
@@ -122,107 +1030,519 @@ def allmapsTransform():
                 reader = csv.reader(file)
                 next(reader)
                 for r in reader:
-                    mapURL = f'https://annotations.allmaps.org/maps/{r[1]}'
+                    mapURL = f'{args.annotationsURL}/maps/{r[1]}'
                     print(f'⤵️ Re-downloading annotation {mapURL}')
-                    annoRequest = requests.get(mapURL, stream=True)
-                    allmapsAnnotation = annoRequest.json()               
-                    with open(f'./tmp/annotations/{r[1]}.json', 'w') as f:
-                        json.dump(allmapsAnnotation, f)
+                    allmapsAnnotation = engine.getJSON(mapURL)
+                    changes[r[1]] = saveAnnotation(r[1], allmapsAnnotation)
+    if changes:
+        reportChanges(changes)
 
+def readMaskRing(file):
 
-    # loop through `path` and 
-    # transform each JSON into GeoJSON
-    # using Allmaps CLI as subprocess
-    
-    for f in os.listdir(path):
-        mapId = os.path.splitext(f)[0]
-        isFile = os.path.isfile(path+f)
-        
-        if not f.startswith('.') and isFile == True:
-            
-            d=json.load(open(path+f))
-            if ((d['body']['features'])):
-                
-                print(f'⤵️ Transforming {f} into a geojson...')
-                name = os.path.splitext(f)[0]+'-transformed.geojson'
-                footprint = open(outPath+name, "w")
-                cmd = ["allmaps", "transform", "resource-mask", f]  # use this to transform strictly from annotation
-                # cmd = ["allmaps", "transform", "--transformation-type", "thinPlateSpline", "resource-mask", f]  # use this for TPS
-                subprocess.run(cmd, cwd=path, stdout=footprint)
-                plateSchema = {"geometry": "Polygon", "properties": {"imageId": "str"}}
-                
-                try:
-                    gdf = gpd.read_file(outPath+name)
-                    request = requests.get(f'https://api.allmaps.org/maps/{mapId}')
-                    response = request.json()
-                    uri = response['_allmaps']['id'][-16:]
-                    gdf.to_file(outPath+name, driver="GeoJSON", schema=plateSchema)
-                except:
-                    invalid.append(f'https://editor.allmaps.org/#/mask?url={uri}/info.json')
-                    invalidIDs.append(mapId)
+    # read a transformed mask back as written, so an unclosed ring is caught
 
-            # save geojson to file
+    try:
+        geojson = json.load(open(file))
+        geometry = geojson['features'][0]['geometry'] if 'features' in geojson else geojson.get('geometry', geojson)
+        return np.array(geometry['coordinates'][0], dtype=float)
+    except (ValueError, KeyError, IndexError, TypeError):
+        return np.zeros((0, 2))
 
-    if (invalid):
+def maskInputs(record):
+
+    # what a transformed mask is built from
+
+    return {
+        'annotation': record.hash,
+        'transform': hashJSON([args.transformEngine, args.transformationType, args.polynomialOrder,
+                               args.maxOffsetRatio, args.maxDepth, args.repairMasks])
+    }
+
+def transformMask(engine, f, ring=None):
+
+    # transform one annotation into GeoJSON, natively
+    # or using Allmaps CLI as subprocess; `ring` may hold a mask
+    # already transformed in bulk. returns the mask as
+    # (mapId, ring, imageId), or None if there was nothing to
+    # transform, and the editor link if its GCPs can't be fitted
+
+    path = "./tmp/annotations/"
+    outPath = path+"transformed/"
+    mapId = os.path.splitext(f)[0]
+            
+    d = annotationStore().get(mapId)
+    if d is None or not len(d.pixels):
+        return None, None
+                
+    name = os.path.splitext(f)[0]+'-transformed.geojson'
+    imageId = d.imageId
+    inputs = maskInputs(d)
+    reuse, reason = checkArtifact(outPath+name, inputs)
+    if reuse:
+        print(f'⏭️   Reusing {name}, {reason}...')
+        return (mapId, readMaskRing(outPath+name), imageId), None
+
+    print(f'⤵️ Transforming {f} into a geojson...')
+    if args.transformEngine == 'allmaps':
+        footprint = open(outPath+name, "w")
+        cmd = ["allmaps", "transform", *allmapsTransformOptions(), "resource-mask", f]  # options empty: transform strictly from annotation
+        subprocess.run(cmd, cwd=path, stdout=footprint)
+        footprint.close()
+
+        ring = readMaskRing(outPath+name)
+    else:
+        try:
+            ring = ring if ring is not None else fitAndTransform(d)
+        except (ValueError, np.linalg.LinAlgError) as e:
+            print(f'‼️   Could not transform {f}: {e}')
+            return None, f"https://editor.allmaps.org/#/georeference?url={imageId}/info.json"
+    if len(ring):
+        writeMaskGeoJSON(outPath+name, ring, imageId)
+        recordArtifact(outPath+name, inputs, reason)
+    return (mapId, ring, imageId), None
+
+def validateMasks(rings):
+
+    # check every mask at once with vectorized Shapely predicates:
+    # ring closure, vertex count, self-intersection, zero area and
+    # validity. returns the problems found for each ring
+
+    problems = [[] for r in rings]
+    counts = np.array([len(r) for r in rings])
+    closed = np.array([len(r) > 0 and np.array_equal(r[0], r[-1]) for r in rings], dtype=bool)
+    distinct = np.array([len(np.unique(r, axis=0)) for r in rings], dtype=int)
+    for i in np.flatnonzero(~closed):
+        problems[i].append('ring is not closed')
+    for i in np.flatnonzero(distinct < 3):
+        problems[i].append(f'only {distinct[i]} distinct vertices')
+
+    ok = np.flatnonzero(distinct >= 3)
+    if len(ok):
+        coords = np.vstack([rings[i] for i in ok])
+        shells = geom.linearrings(coords, indices=np.repeat(np.arange(len(ok)), counts[ok]))
+        polygons = geom.polygons(shells)
+        simple = geom.is_simple(shells)
+        zeroArea = geom.area(polygons) == 0
+        valid = geom.is_valid(polygons)
+        reasons = geom.is_valid_reason(polygons)
+        for j, i in enumerate(ok):
+            if not simple[j]:
+                problems[i].append('ring intersects itself')
+            if zeroArea[j]:
+                problems[i].append('zero area')
+            if not valid[j] and simple[j] and not zeroArea[j]:
+                problems[i].append(reasons[j])
+    return problems
+
+def repairMask(ring):
+
+    # `make_valid` (or `buffer(0)`) the mask and keep its
+    # largest polygon, since a cutline must be a single polygon
+
+    polygon = geom.Polygon(ring)
+    repaired = polygon.buffer(0) if args.repairMasks == 'buffer' else geom.make_valid(polygon)
+    parts = [p for p in geom.get_parts(geom.get_parts(repaired)) if p.geom_type in ('Polygon', 'MultiPolygon')]
+    parts = [p for part in parts for p in geom.get_parts(part) if not p.is_empty]
+    if not parts:
+        return None, 0
+    largest = max(parts, key=lambda p: p.area)
+    return np.array(largest.exterior.coords), len(parts) - 1
+
+def editorLink(engine, mapId, imageId):
+
+    # the Allmaps API is only asked about masks that failed
+
+    try:
+        response = engine.getJSON(f'{args.allmapsAPIURL}/maps/{mapId}')
+        uri = response['_allmaps']['id'][-16:]
+    except (requests.RequestException, KeyError, ValueError):
+        uri = imageId
+    return f'https://editor.allmaps.org/#/mask?url={uri}/info.json'
+
+def checkMasks(engine, masks):
+
+    # validate `masks` in bulk, repair them if `--repair-masks`
+    # is set, and look up editor links for the ones still failing.
+    # returns the failing map IDs and their links
+
+    outPath = "./tmp/annotations/transformed/"
+    failed = []
+    for (mapId, ring, imageId), found in zip(masks, validateMasks([m[1] for m in masks])):
+        if found and args.repairMasks != 'none' and len(ring):
+            repaired, dropped = repairMask(ring)
+            if repaired is not None and not validateMasks([repaired])[0]:
+                note = f', dropped {dropped} smaller part(s)' if dropped else ''
+                print(f'🩹   Repaired mask {mapId} ({"; ".join(found)}{note})')
+                writeMaskGeoJSON(f'{outPath}{mapId}-transformed.geojson', repaired, imageId)
+                continue
+        if found:
+            print(f'‼️   Invalid mask {mapId}: {"; ".join(found)}')
+            failed.append((mapId, imageId))
+    links = engine.map(lambda m: editorLink(engine, *m), failed)
+    return [mapId for mapId, imageId in failed], links
+
+def reportInvalidMasks(invalid, invalidIDs):
+    print(" ")
+    print("‼️   Errors were encountered. Fix the following.")
+    print("‼️   Hold down `command` and double-click the links to open them in your browser.")
+    print("‼️   When you're done, rerun this step.")
+    print(" ")
+    if os.path.exists("tmp/errors") == False:
+        os.mkdir("tmp/errors")
+    pd.set_option('display.max_colwidth', None)
+    
+    if not invalid:
+        pass
+    else:
+        maskData = {'Allmaps Map ID': invalidIDs, 'Fix Bad Masks': invalid}
+        maskDf = pd.DataFrame(data=maskData)
+        print("Fix Bad Masks")
         print(" ")
-        print("‼️   Errors were encountered. Fix the following.")
-        print("‼️   Hold down `command` and double-click the links to open them in your browser.")
-        print("‼️   When you're done, rerun this step.")
+        print(maskDf)
         print(" ")
-        if os.path.exists("tmp/errors") == False:
-            os.mkdir("tmp/errors")
-        pd.set_option('display.max_colwidth', None)
-        
-        if not invalid:
-            pass
-        else:
-            maskData = {'Allmaps Map ID': invalidIDs, 'Fix Bad Masks': invalid}
-            maskDf = pd.DataFrame(data=maskData)
-            print("Fix Bad Masks")
-            print(" ")
-            print(maskDf)
-            print(" ")
-            maskDf.to_csv("tmp/errors/invalidMasks.csv")
-        
-    # merge, dissolve, specify precision
+        maskDf.to_csv("tmp/errors/invalidMasks.csv")
+
+def preciseGeometries(geometries):
 
+    # optionally simplify, keeping topology, then snap
+    # every vertex to the `--precision` grid
+
+    if args.simplify > 0:
+        geometries = geom.simplify(geometries, args.simplify, preserve_topology=True)
+    if args.precision > 0:
+        geometries = geom.set_precision(geometries, args.precision)
+    return geometries
+
+def writeGeoJSON(file, features):
+
+    # stream (properties, geometry) pairs into a FeatureCollection,
+    # one feature per line, with coordinates rounded to `--precision`
+
+    decimals = max(0, math.ceil(-math.log10(args.precision))) if args.precision > 0 else None
+    with open(file+'.tmp', 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for i, (properties, geometry) in enumerate(features):
+            if decimals is not None:
+                geometry = geom.transform(geometry, lambda coords: np.round(coords, decimals))
+            feature = {"type": "Feature", "properties": properties, "geometry": geom.geometry.mapping(geometry)}
+            f.write((',\n' if i else '') + json.dumps(feature))
+        f.write('\n]}\n')
+    os.replace(file+'.tmp', file)
+
+def readMasks(outPath):
+
+    # stream the transformed masks one file at a time with pyogrio
+
+    for mask in sorted(glob.iglob(outPath+'*.geojson')):
+        meta, fids, geometry, fieldData = pyogrio.raw.read(mask)
+        fields = list(meta['fields'])
+        imageIds = fieldData[fields.index('imageId')] if 'imageId' in fields else [''] * len(geometry)
+        for wkb, imageId in zip(geometry, imageIds):
+            yield imageId, geom.from_wkb(wkb)
+
+def writeFootprints(properties, geometries):
+
+    # copies of `plates.geojson` that consumers can read
+    # by bbox with range requests instead of parsing it whole
+
+    names = list(properties[0])
+    if 'fgb' in args.footprintFormats:
+
+        # FlatGeobuf with its packed Hilbert R-tree
+
+        types = set(geom.get_type_id(geometries))
+        geometryType = {3: 'Polygon', 6: 'MultiPolygon'}.get(types.pop(), 'Unknown') if len(types) == 1 else 'Unknown'
+        pyogrio.raw.write("output/plates.fgb", geom.to_wkb(geometries),
+                          [np.array([p[n] for p in properties], dtype=object) for n in names], names,
+                          driver='FlatGeobuf', geometry_type=geometryType, crs='EPSG:4326',
+                          layer_options={'SPATIAL_INDEX': 'YES'})
+        print("🗂️   Wrote `output/plates.fgb`")
+    if 'parquet' in args.footprintFormats:
+
+        # GeoParquet with a bbox covering column for row-group filtering
+
+        gpd.GeoDataFrame(properties, geometry=geometries, crs='EPSG:4326').to_parquet("output/plates.parquet", write_covering_bbox=True)
+        print("🗂️   Wrote `output/plates.parquet`")
+
+def mortonCode(x, y):
+
+    # interleave the bits of two arrays of 16-bit integers
+    # into their position along a Z-order curve
+
+    def spread(v):
+        v = np.asarray(v, dtype=np.uint64) & 0xFFFF
+        v = (v | (v << 8)) & 0x00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F
+        v = (v | (v << 2)) & 0x33333333
+        return (v | (v << 1)) & 0x55555555
+    return spread(x) | (spread(y) << 1)
+
+def touchingGroups(geometries):
+
+    # label clusters of plates that touch or overlap,
+    # from the pairs an STRtree finds
+
+    tree = geom.STRtree(geometries)
+    i, j = tree.query(geometries, predicate='intersects')
+    labels = np.arange(len(geometries))
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, i, labels[j])
+        np.minimum.at(labels, j, labels[i])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+def unionChunk(wkbs):
+    return geom.to_wkb(geom.union_all(geom.from_wkb(wkbs)))
+
+def hasCoverageCheck():
+    return hasattr(geom, 'coverage_is_valid') and geom.geos_version >= (3, 12, 0)
+
+def dissolvePlates(geometries, workers=1):
+
+    # plates that form a valid coverage (matching edges, no overlaps)
+    # are merged with the much cheaper coverage union. otherwise they
+    # are grouped into touching clusters, ordered along a Z-curve and
+    # unioned in chunks across worker processes, and the chunk
+    # results are unioned once more. checking the coverage needs
+    # Shapely 2.1 and GEOS 3.12; older versions always take the
+    # cluster path
+
+    geometries = np.asarray(geometries, dtype=object)
+    if hasCoverageCheck() and geom.coverage_is_valid(geometries):
+        print("🧩   Plates form a coverage, dissolving with a coverage union...")
+        return geom.coverage_union_all(geometries)
+
+    xy = geom.get_coordinates(geom.centroid(geometries))
+    span = np.ptp(xy, axis=0)
+    span[span == 0] = 1
+    cells = ((xy - xy.min(axis=0)) / span * 0xFFFF).astype(np.uint64)
+    order = np.lexsort((mortonCode(cells[:, 0], cells[:, 1]), touchingGroups(geometries)))
+    workers = max(1, min(workers, len(geometries) // 128))
+    if workers == 1:
+        return geom.union_all(geometries[order])
+    chunks = [geom.to_wkb(geometries[c]) for c in np.array_split(order, workers * 4)]
+    print(f"🧩   Dissolving {len(geometries)} plates in {len(chunks)} chunks across {workers} processes...")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = geom.from_wkb(list(pool.map(unionChunk, chunks)))
+    return geom.union_all(parts)
+
+def runDissolveTrial(method, wkbs, workers):
+
+    # runs in a fresh process so its peak memory is its own
+
+    geometries = geom.from_wkb(wkbs)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    start = time.perf_counter()
+    if method == 'geopandas':
+        gpd.GeoDataFrame(geometry=geometries).dissolve()
     else:
-        print("✅   All pixel masks transformed!\n")
-        print("Generating `plates.geojson` file...\n")
+        dissolvePlates(geometries, workers)
+    seconds = time.perf_counter() - start
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+    return seconds, max(0, peak - baseline)
+
+def benchmarkDissolve():
+
+    # time and peak memory of `GeoDataFrame.dissolve()` against
+    # `dissolvePlates` as plate count grows; beyond the atlas itself,
+    # shifted, overlapping copies stand in for multi-volume atlases
+
+    meta, fids, wkbs, fieldData = pyogrio.raw.read("output/plates.geojson")
+    plates = geom.from_wkb(wkbs)
+    xmin, ymin, xmax, ymax = geom.total_bounds(plates)
+    copies = [geom.transform(plates, lambda c, k=k: c + [k * 0.9 * (xmax - xmin), 0]) for k in range(args.benchmarkCopies)]
+    everything = np.concatenate(copies)
+    counts = sorted(set([max(1, len(plates) // 4), max(1, len(plates) // 2)] + [len(plates) * k for k in range(1, args.benchmarkCopies + 1)]))
+
+    rows = []
+    print(f"{'plates':>8} {'method':>10} {'seconds':>10} {'+peak MB':>10}")
+    for count in counts:
+        for method in ['geopandas', 'native']:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                seconds, peak = pool.submit(runDissolveTrial, method, geom.to_wkb(everything[:count]), args.dissolveWorkers).result()
+            rows.append({'plates': count, 'method': method, 'seconds': round(seconds, 3), 'peakMB': round(peak / 2**20, 1)})
+            print(f"{count:>8} {method:>10} {seconds:>10.2f} {peak / 2**20:>10.1f}")
+    pd.DataFrame(rows).to_csv("tmp/benchmark-dissolve.csv", index=False)
+    print("✅   Results saved to `tmp/benchmark-dissolve.csv`")
+
+def mergePlates():
+
+    outPath = "./tmp/annotations/transformed/"
+    print("Generating `plates.geojson` file...\n")
+
+    # merge masks, appending each one to `plates.geojson`
+    # as it is read, snapped to the precision grid
+
+    fields = ['identifier', 'name', 'allmapsMapID', 'digitalCollectionsPermalinkPlate']
+    properties = []
+    geometries = []
+
+    def plates():
+        for imageId, geometry in readMasks(outPath):
+            record = {'imageId': imageId, **{field: '' for field in fields}}
+            geometry = preciseGeometries(geometry)
+            properties.append(record)
+            geometries.append(geometry)
+            yield record, geometry
+
+    writeGeoJSON("output/plates.geojson", plates())
+    if not geometries:
+        print("‼️   No transformed masks found in `tmp/annotations/transformed`.")
+        return False
+    geometries = np.array(geometries, dtype=object)
+    writeFootprints(properties, geometries)
+
+    # dissolve plates and
+    # save it at the same precision
+   
+    try:
+        diss = dissolvePlates(geometries, args.dissolveWorkers)
+        writeGeoJSON("tmp/plates-dissolved.geojson", [(properties[0], preciseGeometries(diss))])
+        if os.path.exists("tmp/errors") == True:
+            print("You can delete the `tmp/errors` directory.\n")
+        print("✅   All `plates` files have been created!\n")
+        dissolved = True
+    except (RuntimeError, geom.errors.GEOSException) as e:
+        print(e)
+        dissolved = False
+    return dissolved
+
+def maskDistance(ring, reference):
+
+    # the Hausdorff distance in EPSG:3857 between a native mask and
+    # the CLI's GeoJSON, which also holds when the two masks have
+    # different vertex counts
 
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    toMercator = lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+    expected = geom.transform(gpd.read_file(reference).geometry.iloc[0], toMercator)
+    actual = geom.transform(geom.Polygon(ring), toMercator)
+    return geom.hausdorff_distance(actual, expected)
+
+def allmapsTransformOptions():
+
+    # the CLI flags matching the native engine's options,
+    # so recorded references are made with the same settings
+
+    options = []
+    if args.transformationType:
+        options += ["--transformation-type", args.transformationType]
+    if args.polynomialOrder:
+        options += ["--polynomial-order", str(args.polynomialOrder)]
+    if args.maxOffsetRatio:
+        options += ["--max-offset-ratio", str(args.maxOffsetRatio)]
+    if args.maxDepth:
+        options += ["--max-depth", str(args.maxDepth)]
+    return options
+
+def verifyTransform():
+
+    # compare native masks against `allmaps transform resource-mask`
+    # output recorded in `--reference-dir`, recording any that
+    # are missing if the CLI is installed. the CLI version that
+    # recorded them is kept in `allmaps-cli-version.txt`
 
-        # merge masks using geopandas
+    path = "./tmp/annotations/"
+    refPath = args.referenceDir
+    os.makedirs(refPath, exist_ok=True)
+    records = annotationStore().all()
+    files = [r.mapId+'.json' for r in records]
+    withGCPs = [i for i, r in enumerate(records) if len(r.pixels)]
+    rings = transformAnnotations([records[i] for i in withGCPs])
+
+    compared = 0
+    failures = []
+    for i, ring in zip(withGCPs, rings):
+        mapId = os.path.splitext(files[i])[0]
+        reference = f'{refPath}{mapId}-transformed.geojson'
+        if not os.path.isfile(reference):
+            if shutil.which('allmaps') is None:
+                print(f'⏭️   No recorded CLI output for {mapId} and no `allmaps` CLI to record it, skipping...')
+                continue
+            cmd = ["allmaps", "transform", *allmapsTransformOptions(), "resource-mask", files[i]]
+            with open(reference, 'w') as out:
+                recorded = subprocess.run(cmd, cwd=path, stdout=out)
+            if recorded.returncode != 0:
+                os.remove(reference)
+                failures.append((mapId, float('inf')))
+                print(f'‼️   `allmaps transform resource-mask` failed for {mapId}')
+                continue
+            version = subprocess.run(["allmaps", "--version"], capture_output=True, text=True).stdout.strip()
+            with open(f'{refPath}allmaps-cli-version.txt', 'w') as f:
+                f.write(version + '\n')
+        if ring is None:
+            failures.append((mapId, float('inf')))
+            continue
+        distance = maskDistance(ring, reference)
+        compared += 1
+        if distance > args.transformTolerance:
+            failures.append((mapId, distance))
+        print(f'{"✅" if distance <= args.transformTolerance else "‼️ "}  {mapId}: {distance:.4f} m')
 
-        masks = glob.iglob(outPath+'*.geojson')
-        plates = gpd.pd.concat([gpd.read_file(mask) for mask in masks])
-        fields = ['identifier', 'name', 'allmapsMapID', 'digitalCollectionsPermalinkPlate']
-        plates[fields] = ''
-        polySchema = {"geometry": "Polygon", "properties": {"imageId": "str", "identifier": "str", "name": "str", "allmapsMapID": "str", "digitalCollectionsPermalinkPlate": "str"}}
-        multipolySchema = {"geometry": "MultiPolygon", "properties": {"imageId": "str", "identifier": "str", "name": "str", "allmapsMapID": "str", "digitalCollectionsPermalinkPlate": "str"}}
-        plates.to_file("output/plates.geojson", driver="GeoJSON", schema=polySchema)
+    print(" ")
+    if failures:
+        print(f"‼️   {len(failures)} of {compared} masks differ from the CLI by more than {args.transformTolerance} m")
+        sys.exit(1)
+    print(f"✅   All {compared} native masks are within {args.transformTolerance} m of the CLI output!")
 
-        # dissolve plates file and
-        # save according to geometry type
-       
-        try:
-            diss = plates.dissolve()
-            multiPolyCheck = 'MultiPolygon' in diss['geometry'].geom_type.values
-            if multiPolyCheck == True:
-                diss.to_file("tmp/plates-dissolved.geojson", driver="GeoJSON", schema=multipolySchema)
-            else:
-                diss.to_file("tmp/plates-dissolved.geojson", driver="GeoJSON", schema=polySchema)
-            if os.path.exists("tmp/errors") == True:
-                print("You can delete the `tmp/errors` directory.\n")
-            print("✅   All `plates` files have been created!\n")
-            print("You can now proceed to the `warp-plates` step.\n")
-        except RuntimeError as e:
-            print(e)
+def allmapsTransform():
+    
+    # define path variables and lists for error handling
+
+    path = "./tmp/annotations/"
+    invalid = []
+    invalidIDs = []
+
+    engine = createEngine()
+    redownloadErrors(engine)
+
+    # transform every mask in one vectorized call,
+    # then loop through `path` and save each JSON as GeoJSON
+
+    start = time.time()
+    records = annotationStore().all()
+    files = [r.mapId+'.json' for r in records]
+    rings = [None] * len(files)
+    if args.transformEngine == 'native':
+
+        # masks whose annotation is unchanged are reused by `transformMask`
+
+        stale = lambda r: not checkArtifact(f'{path}transformed/{r.mapId}-transformed.geojson', maskInputs(r))[0]
+        withGCPs = [i for i, r in enumerate(records) if len(r.pixels) and stale(r)]
+        for i, ring in zip(withGCPs, transformAnnotations([records[i] for i in withGCPs])):
+            rings[i] = ring
+
+    masks = []
+    for f, ring in zip(files, rings):
+        mapId = os.path.splitext(f)[0]
+        mask, link = transformMask(engine, f, ring)
+        if link:
+            invalid.append(link)
+            invalidIDs.append(mapId)
+        elif mask:
+            masks.append(mask)
+
+    # validate all masks locally and in bulk
+
+    failedIDs, links = checkMasks(engine, masks)
+    invalid += links
+    invalidIDs += failedIDs
+
+    engine.printCacheStats()
+    reportArtifacts(start)
+
+    if (invalid):
+        reportInvalidMasks(invalid, invalidIDs)
         
-        # trim to 4 decimal pts
+    # merge, dissolve, specify precision
 
-        out=open("plates-precise.geojson", "w")
-        cmd=["mapshaper", "plates-dissolved.geojson", "-o", "precision=0.0001", "plates-precise.geojson"]
-        subprocess.run(cmd, cwd="tmp/", stdout=out)
+    else:
+        print("✅   All pixel masks transformed!\n")
+        if mergePlates():
+            print("You can now proceed to the `warp-plates` step.\n")
     return
 
 #########################################
@@ -233,99 +1553,531 @@ def allmapsTransform():
 #####                               #####
 #########################################
 
-def warpPlates():
+def readCutline(mapId):
+    meta, fids, geometry, fieldData = pyogrio.raw.read(f'./tmp/annotations/transformed/{mapId}-transformed.geojson')
+    return geom.union_all(geom.from_wkb(geometry))
 
-    # create empty lists for error handling and
-    # set transformation and path variables
+def tileBounds(mapId):
+
+    # bbox of the mask in EPSG:3857, grown to whole `--max-zoom`
+    # tiles of the web mercator grid, whose origin is its top left corner
 
-    gdal.UseExceptions()
     transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-    path="./tmp/annotations/"
+    lon, lat = geom.get_coordinates(readCutline(mapId)).T
+    x, y = transformer.transform(lon, lat)
+    origin = WEB_MERCATOR_RESOLUTION * 256 / 2
+    tile = tileResolution(args.maxZoom) * 256
+    x0, x1 = [math.floor((x.min() + origin) / tile), math.ceil((x.max() + origin) / tile)]
+    y0, y1 = [math.floor((origin - y.max()) / tile), math.ceil((origin - y.min()) / tile)]
+    return [x0 * tile - origin, origin - y1 * tile, x1 * tile - origin, origin - y0 * tile]
+
+def cutlineOptions(mapId, cutline=None, srs='OGC:CRS84'):
+
+    # pass the transformed mask (or `cutline`) to GDAL as in-memory
+    # geometry; GDAL before 3.8 has no `cutlineWKT`, so it gets a /vsimem/ file
+
+    cutline = readCutline(mapId) if cutline is None else cutline
+    if 'cutlineWKT' in gdal.WarpOptions.__code__.co_varnames:
+        return {'cutlineWKT': geom.to_wkt(cutline), 'cutlineSRS': srs}
+    gdal.FileFromMemBuffer(f'/vsimem/{mapId}-cutline.geojson', geom.to_geojson(cutline))
+    return {'cutlineDSName': f'/vsimem/{mapId}-cutline.geojson', 'cutlineSRS': srs}
+
+# creation options of the COG `--warp-profile`s; the alpha band of
+# the warp becomes a 1-bit internal mask and blocks left empty
+# outside the rotated mask aren't written
+
+COG_OPTIONS = ['BLOCKSIZE=512', 'OVERVIEWS=AUTO', 'SPARSE_OK=TRUE', 'BIGTIFF=IF_SAFER']
+WARP_PROFILES = {
+    'cog-zstd': COG_OPTIONS + ['COMPRESS=ZSTD', 'PREDICTOR=YES'],
+    'cog-deflate': COG_OPTIONS + ['COMPRESS=DEFLATE', 'PREDICTOR=YES'],
+    'cog-jpeg': COG_OPTIONS + ['COMPRESS=JPEG', 'QUALITY=85'],
+}
+
+def warpSettings():
+
+    # options for GDAL warp, apart from the cutline; the COG
+    # profiles warp into a VRT that is then translated by `writeCOG`
+
+    settings = dict(
+        format='GTiff',
+        copyMetadata=True,
+        multithread=True,
+        dstSRS="EPSG:3857",
+        creationOptions=['COMPRESS=LZW', 'BIGTIFF=YES'],
+        polynomialOrder=1,  # comment this out for TPS
+        resampleAlg='cubic',
+        dstAlpha=True,
+        dstNodata=0,
+        xRes=0.1,
+        yRes=0.1,
+        targetAlignedPixels=True,
+        cropToCutline=True,
+        # tps=True    # comment this out for polynomial
+    )
+    if args.warpProfile != 'legacy':
+        settings.update(format='VRT', creationOptions=None, dstNodata=None)
 
-    # loop through annotations and
-    # perform GDAL warp
+    # with `--tile-aligned` the output bounds come from `tileBounds`,
+    # which GDAL won't combine with `cropToCutline`
 
-    for file in os.listdir(path):
-        isFile = os.path.isfile(path+file)
-        if not file.startswith('.') and isFile == True:
+    if args.tileAligned:
+        settings.update(xRes=tileResolution(args.maxZoom), yRes=tileResolution(args.maxZoom),
+                        targetAlignedPixels=False, cropToCutline=False)
+    if args.errorThreshold is not None:
+        settings.update(errorThreshold=args.errorThreshold)
+    return settings
 
-            print(f'🏔   Registering GCPs from annotation...')
-            annotation = json.load(open(path+file))
-            # print(annotation)
-            commonwealthUrl = annotation['target']['source']['partOf'][0]['id']
-            commId = (commonwealthUrl[-9:])
-            
-            # correlate pixel and spatial coordinates
-            
-            gcps = []
-            for gcp in annotation['body']['features']:
-                    # print(gcp['properties']['resourceCoords'])
-                    xt, yt = transformer.transform(
-                        gcp['geometry']['coordinates'][0], gcp['geometry']['coordinates'][1])
-                    line = float(gcp['properties']['resourceCoords'][1])
-                    pixel = float(gcp['properties']['resourceCoords'][0])
-                    g = gdal.GCP(xt, yt, 0, pixel, line)
-                    gcps.append(g)
-            sourceImg = gdal.Open(f'./tmp/img/{commId}.tif')
-            
-            # # nearblack hack
+def warpTransformation(record):
+    if args.warpTransformation == 'annotation':
+        return transformationFor(record)
+    return 'polynomial', 1
 
-            # for b in [1, 2, 3]:
-            # 	band = archivalImage.GetRasterBand(b)
-            # 	readableBand = band.ReadAsArray()
-            # 	readableBand[np.where(readableBand == 0)] = 1
+def plateWarpSettings(kind, order):
 
-            # set variables for GDAL translate and
-            # execute
+    # `warpSettings` with the transformation of one plate
 
-            translateOptions = gdal.TranslateOptions(
-                format='GTiff',
-                GCPs=gcps,
-                outputSRS='EPSG:3857'
-            )
-            
-            mapId = os.path.splitext(file)[0]
-
-            gdal.Translate(
-                f'./tmp/img/{mapId}-translated.tif',
-                sourceImg,
-                options = translateOptions
-            )
-                        
-            # set options for GDAL warp and
-            # execute
-
-            cutline = f'./tmp/annotations/transformed/{mapId}-transformed.geojson'
-            warpOptions = gdal.WarpOptions(
-                                    format='GTiff',
-                                    copyMetadata=True,
-                                    multithread=True,
-                                    dstSRS="EPSG:3857",
-                                    creationOptions=['COMPRESS=LZW', 'BIGTIFF=YES'],
-                                    polynomialOrder=1,  # comment this out for TPS
-                                    resampleAlg='cubic',
-                                    dstAlpha=True,
-                                    dstNodata=0,
-                                    xRes=0.1,
-                                    yRes=0.1,
-                                    targetAlignedPixels=True,
-                                    cutlineDSName=cutline,
-                                    cropToCutline=True,
-                                    # tps=True    # comment this out for polynomial
-                                    )
-            warpedPlate = f'./tmp/warped/{mapId}-warped.tif'
-            isFile = os.path.isfile(warpedPlate)
-
-            if isFile == True:
-                print(f'⏭️   Skipping {warpedPlate}, already exists...')
-                os.remove(f'./tmp/img/{mapId}-translated.tif')
-            else:
-                print(f'💫 Creating warped TIFF in EPSG:3857 for {mapId}.json')
-                gdal.Warp(f'./tmp/warped/{mapId}-warped.tif',
-                            f'./tmp/img/{mapId}-translated.tif', options=warpOptions)
+    settings = warpSettings()
+    if kind == 'thinPlateSpline':
+        del settings['polynomialOrder']
+        settings.update(tps=True)
+    else:
+        settings.update(polynomialOrder=order)
+    return settings
+
+def decimateGCPs(pixels, count):
+
+    # indices of `count` GCPs spread over the image, by farthest
+    # point sampling: each pick is the GCP furthest from those
+    # already picked. a thin plate spline costs O(n) per pixel,
+    # so dense annotations warp much faster on a spread subset
+
+    if not count or len(pixels) <= count:
+        return np.arange(len(pixels))
+    picked = [int(np.argmax(((pixels - pixels.mean(axis=0)) ** 2).sum(axis=1)))]
+    distance = ((pixels - pixels[picked[0]]) ** 2).sum(axis=1)
+    for i in range(count - 1):
+        picked.append(int(np.argmax(distance)))
+        distance = np.minimum(distance, ((pixels - pixels[picked[-1]]) ** 2).sum(axis=1))
+    return np.sort(picked)
+
+def gcpResiduals(record, used, kind, order):
+
+    # distance in EPSG:3857 units between each GCP and where
+    # the transformation fitted to the `used` GCPs puts it. a thin
+    # plate spline passes through every GCP it was fitted to, so
+    # those get a leave-one-out residual instead: the error at the
+    # GCP of the spline fitted to the others
+
+    try:
+        fit = fitTransform(record.pixels[used], record.geo[used], kind, order)
+    except (ValueError, np.linalg.LinAlgError):
+        return np.full(len(record.pixels), np.nan)
+    predicted = evaluateTransforms([fit], record.pixels, np.zeros(len(record.pixels), dtype=int))
+    residuals = np.linalg.norm(predicted - record.geo, axis=1)
+    if kind == 'thinPlateSpline':
+        for i in used:
+            others = used[used != i]
+            try:
+                fit = fitTransform(record.pixels[others], record.geo[others], kind, order)
+            except (ValueError, np.linalg.LinAlgError):
+                residuals[i] = np.nan
+                continue
+            residuals[i] = np.linalg.norm(evaluateTransforms([fit], record.pixels[i:i+1], np.zeros(1, dtype=int))[0] - record.geo[i])
+    return residuals
+
+def cogOptions():
+
+    # COG creation options; with `--tile-aligned` each
+    # internal block is exactly one `--max-zoom` tile
+
+    options = WARP_PROFILES.get(args.warpProfile)
+    if options and args.tileAligned:
+        options = ['BLOCKSIZE=256' if o.startswith('BLOCKSIZE=') else o for o in options]
+    return options
+
+def writeCOG(warpedPlate, warped):
+
+    # copy the warped VRT into a COG: RGB bands 1-3, band 4
+    # (alpha) as the mask, overviews built by the COG driver
+
+    options = cogOptions() + [f"NUM_THREADS={gdal.GetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')}"]
+    gdal.Translate(warpedPlate, warped, options=gdal.TranslateOptions(
+        format='COG',
+        bandList=[1, 2, 3],
+        maskBand=4,
+        creationOptions=options
+    ))
+
+def plateInputs(record, used, kind, order, sourceFile, regionFile=None):
+
+    # what a warped plate is built from
+
+    return {
+        'gcps': record.gcpHash if len(used) == len(record.pixels) else hashJSON([record.gcpHash, used.tolist()]),
+        'mask': hashFile(f'./tmp/annotations/transformed/{record.mapId}-transformed.geojson').hexdigest(),
+        'warp': hashJSON([plateWarpSettings(kind, order), cogOptions()]),
+        'source': hashJSON([sourceHash(sourceFile), readJSONFile(regionFile) if regionFile else None])
+    }
+
+def warpPlate(file, measure=True):
+
+    # register the GCPs of one annotation
+    # and perform GDAL warp. `measure` records peak RSS and I/O
+    # for the plate, which only holds when it has the process
+    # to itself (not in the threads of `pipeline`)
+
+    mapId = os.path.splitext(file)[0]
+    record = annotationStore().get(mapId)
+    commId = record.commId
+    regionFile = f'./tmp/img/{mapId}-region.json'
+    useRegion = args.source == 'iiif' and os.path.isfile(regionFile)
+    sourceFile = f'./tmp/img/{mapId}-region.tif' if useRegion else f'./tmp/img/{commId}.tif'
+
+    kind, order = warpTransformation(record)
+    used = decimateGCPs(record.pixels, args.maxGCPs) if kind == 'thinPlateSpline' else np.arange(len(record.pixels))
+
+    # reuse a finished plate only if its GCPs, mask,
+    # warp options and source image are unchanged
+
+    warpedPlate = f'./tmp/warped/{mapId}-warped.tif'
+    inputs = plateInputs(record, used, kind, order, sourceFile, regionFile if useRegion else None)
+    reuse, reason = checkArtifact(warpedPlate, inputs)
+    if reuse:
+        print(f'⏭️   Skipping {warpedPlate}, {reason}...')
+        return
+    discardArtifact(warpedPlate)
+
+    print(f'🏔   Registering GCPs from annotation ({reason})...')
+    if measure:
+        resetPeakMemory()
+        before = processStats()
+    logWarp('start', mapId)
+    
+    # correlate pixel and spatial coordinates
+    
+    # a IIIF region starts at (x, y) of the full image and is
+    # scaled down, so shift and scale the pixel coordinates to match
+
+    sourceImg = gdal.Open(sourceFile)
+    if useRegion:
+        region = readJSONFile(regionFile)
+        offsetX, offsetY = region['x'], region['y']
+        scaleX, scaleY = sourceImg.RasterXSize / region['w'], sourceImg.RasterYSize / region['h']
+    else:
+        offsetX, offsetY, scaleX, scaleY = 0, 0, 1, 1
+    
+    pixels = (record.pixels - [offsetX, offsetY]) * [scaleX, scaleY]
+    gcps = [gdal.GCP(xt, yt, 0, pixel, line) for (xt, yt), (pixel, line) in zip(record.geo[used].tolist(), pixels[used].tolist())]
+    
+    # # nearblack hack
+
+    # for b in [1, 2, 3]:
+    # 	band = archivalImage.GetRasterBand(b)
+    # 	readableBand = band.ReadAsArray()
+    # 	readableBand[np.where(readableBand == 0)] = 1
+
+    # attach the GCPs through an in-memory VRT,
+    # which references the source pixels instead of copying them
+
+    translateOptions = gdal.TranslateOptions(
+        format='VRT',
+        GCPs=gcps,
+        outputSRS='EPSG:3857'
+    )
+    georeferenced = gdal.Translate(f'/vsimem/{mapId}.vrt', sourceImg, options = translateOptions)
+                
+    # set options for GDAL warp and
+    # execute
+
+    settings = {**plateWarpSettings(kind, order), **cutlineOptions(mapId)}
+    if args.tileAligned:
+        settings['outputBounds'] = tileBounds(mapId)
+
+    # with `--memory-budget`, a legacy plate too big for its share of
+    # block cache and warp buffer is warped into a VRT and written in windows
+
+    windowed = bool(warpMemory and args.warpProfile == 'legacy' and warpedSize(file) * 4 > 2 * warpMemory)
+    if warpMemory:
+        settings['warpMemoryLimit'] = warpMemory
+    if windowed:
+        settings.update(format='VRT', creationOptions=None)
+    warpOptions = gdal.WarpOptions(**settings)
+
+    print(f'💫 Creating warped TIFF in EPSG:3857 for {mapId}.json')
+    start = time.monotonic()
+    warped = None
+    try:
+        if windowed:
+            warped = gdal.Warp(f'/vsimem/{mapId}-warped.vrt', georeferenced, options=warpOptions)
+            rows = max(1, warpMemory // (warped.RasterXSize * warped.RasterCount))
+            print(f'🪟  Writing {mapId} in windows of {rows} lines to stay within --memory-budget')
+            writeWindowed(warpedPlate, warped, rows)
+        elif args.warpProfile == 'legacy':
+            gdal.Warp(warpedPlate, georeferenced, options=warpOptions)
+        else:
+            warped = gdal.Warp(f'/vsimem/{mapId}-warped.vrt', georeferenced, options=warpOptions)
+            writeCOG(warpedPlate, warped)
+        recordArtifact(warpedPlate, inputs, reason)
+        print(f'📦  {warpedPlate} is {os.path.getsize(warpedPlate) / 2**20:.1f}MB')
+        seconds = time.monotonic() - start
+    except Exception:
+
+        # don't leave a partial plate behind
+
+        discardArtifact(warpedPlate)
+        raise
+    finally:
+        georeferenced = warped = None
+        for temporary in [f'/vsimem/{mapId}.vrt', f'/vsimem/{mapId}-warped.vrt', f'/vsimem/{mapId}-cutline.geojson']:
+            if gdal.VSIStatL(temporary) is not None:
+                gdal.Unlink(temporary)
+
+    # report how well the transformation fits the GCPs,
+    # including any left out by `--max-gcps`
+
+    residuals = gcpResiduals(record, used, kind, order)
+    transformation = kind if kind == 'thinPlateSpline' else f'{kind} {order}'
+    print(f'📐  {mapId}: {transformation} on {len(used)}/{len(record.pixels)} GCPs, '
+          f'{"leave-one-out " if kind == "thinPlateSpline" else ""}residuals '
+          f'{np.sqrt(np.mean(residuals ** 2)):.2f}m RMS, {np.max(residuals):.2f}m max, warped in {seconds:.0f}s')
+
+    row = {'mapId': mapId, 'transformation': transformation, 'gcps': len(record.pixels), 'gcpsUsed': len(used),
+           'rmsResidual': np.sqrt(np.mean(residuals ** 2)), 'maxResidual': np.max(residuals), 'warpSeconds': seconds}
+    if not measure:
+        logWarp('done', mapId, seconds=seconds, windowed=windowed)
+        return row
+
+    # peak memory and bytes moved while warping this plate
+
+    after = processStats()
+    moved = {k: after[k] - before[k] for k in ['rchar', 'wchar', 'read_bytes', 'write_bytes'] if k in after}
+    logWarp('done', mapId, seconds=seconds, windowed=windowed, peakRSS=after['peakRSS'], **moved)
+    print(f"🧮  {mapId}: peak RSS {after['peakRSS'] / 2**20:.0f}MB, read {moved.get('rchar', 0) / 2**20:.0f}MB, "
+          f"wrote {moved.get('wchar', 0) / 2**20:.0f}MB")
+    return {**row, 'peakRSSMB': after['peakRSS'] / 2**20, 'readMB': moved.get('rchar', 0) / 2**20,
+            'writtenMB': moved.get('wchar', 0) / 2**20}
+
+def writeWarpReport(rows):
+
+    # update `tmp/warp-report.csv` with the plates warped
+    # this run, keeping the rows of plates that were reused
+
+    reportFile = 'tmp/warp-report.csv'
+    report = pd.DataFrame([r for r in rows if r]).round(3)
+    if report.empty:
+        return
+    if os.path.isfile(reportFile):
+        previous = pd.read_csv(reportFile, dtype={'mapId': str})
+        report = pd.concat([previous[~previous['mapId'].isin(report['mapId'])], report])
+    report.sort_values('mapId').to_csv(reportFile, index=False)
+    print(f"📐 GCP residuals and warp times are in `{reportFile}`")
 
-                print(f'🚮   Deleting temporary translate file for {mapId}.json')
-                os.remove(f'./tmp/img/{mapId}-translated.tif')
+def plateFiles():
+    return [r.mapId+'.json' for r in annotationStore().all()]
+
+def warpedSize(file):
+
+    # estimated pixel count of a warped plate: the mask bbox
+    # in source pixels, scaled to the output resolution
+
+    # an unreadable annotation sorts last and fails in `warpPlate`
+
+    try:
+        record = annotationStore().get(os.path.splitext(file)[0])
+        x0, y0, x1, y1 = maskBounds(record)
+        return (x1 - x0) * (y1 - y0) * (sourcePixelSize(record) / warpSettings()['xRes']) ** 2
+    except Exception:
+        return 0
+
+# bytes of warp buffer each warp may use, set from `--memory-budget`
+
+warpMemory = None
+
+def memoryShare(jobs):
+
+    # split `--memory-budget` between `jobs` concurrent warps: a
+    # quarter of each share for the block cache, a quarter for the
+    # warp buffer, the rest for the source, transformer and Python
+
+    if not args.memoryBudget:
+        return None, None
+    share = args.memoryBudget * 2**20 // jobs
+    return share // 4, share // 4
+
+def initWarpWorker(threads, cacheMax, warpBytes=None):
+
+    # each worker gets its share of the cores and block cache,
+    # so `--jobs` processes don't oversubscribe the machine
+
+    global warpMemory
+    gdal.UseExceptions()
+    if threads:
+        gdal.SetConfigOption('GDAL_NUM_THREADS', str(threads))
+    if cacheMax:
+        gdal.SetCacheMax(cacheMax)
+    warpMemory = warpBytes
+
+def resetPeakMemory():
+
+    # writing 5 to clear_refs resets VmHWM, the peak RSS,
+    # so it can be read per plate (Linux only)
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def processStats():
+
+    # peak RSS and I/O counters of this process, from /proc where
+    # available; elsewhere the peak since the process started
+
+    stats = {'peakRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    try:
+        with open('/proc/self/status') as f:
+            stats['peakRSS'] = next(int(l.split()[1]) * 1024 for l in f if l.startswith('VmHWM:'))
+        with open('/proc/self/io') as f:
+            stats.update({k: int(v) for k, v in (l.split(': ') for l in f)})
+    except (OSError, StopIteration):
+        pass
+    return stats
+
+def logWarp(event, mapId, **fields):
+
+    # append one line to `tmp/warp-run.log`; a plate that started but
+    # never finished is the one that took its worker down
+
+    line = json.dumps({'time': time.time(), 'pid': os.getpid(), 'event': event, 'mapId': mapId, **fields})
+    with open('tmp/warp-run.log', 'a') as f:
+        f.write(line + '\n')
+
+def writeWindowed(warpedPlate, warped, rows):
+
+    # copy the warped VRT to a GeoTIFF `rows` lines at a time; each
+    # read warps just that window, so memory stays bounded
+
+    width, height = warped.RasterXSize, warped.RasterYSize
+    out = gdal.GetDriverByName('GTiff').Create(warpedPlate, width, height, warped.RasterCount, gdal.GDT_Byte,
+                                               options=warpSettings()['creationOptions'])
+    out.SetGeoTransform(warped.GetGeoTransform())
+    out.SetProjection(warped.GetProjection())
+    for b in range(1, warped.RasterCount + 1):
+        band = warped.GetRasterBand(b)
+        out.GetRasterBand(b).SetColorInterpretation(band.GetColorInterpretation())
+        if band.GetNoDataValue() is not None:
+            out.GetRasterBand(b).SetNoDataValue(band.GetNoDataValue())
+    for y in range(0, height, rows):
+        lines = min(rows, height - y)
+        out.WriteRaster(0, y, width, lines, warped.ReadRaster(0, y, width, lines))
+        out.FlushCache()
+    out = None
+
+def tryWarpPlate(file):
+    start = time.monotonic()
+    try:
+        row = warpPlate(file)
+    except Exception as e:
+        return file, time.monotonic() - start, repr(e), None
+    return file, time.monotonic() - start, None, row
+
+def reportWarpedSizes():
+    plates = glob.glob('tmp/warped/*.tif')
+    size = sum(os.path.getsize(p) for p in plates)
+    print(f"📦 {len(plates)} warped plates take {size / 2**20:.0f}MB ({args.warpProfile} profile)")
+
+def reportWarpErrors(failed):
+
+    # write failed plates to `tmp/errors/warpErrors.csv`,
+    # clearing the list left by an earlier run once they succeed
+
+    errorFile = "tmp/errors/warpErrors.csv"
+    if not failed:
+        if os.path.isfile(errorFile):
+            os.remove(errorFile)
+        return
+    if os.path.exists("tmp/errors") == False:
+        os.mkdir("tmp/errors")
+    pd.DataFrame(failed, columns=['id', 'error']).to_csv(errorFile, index=False)
+    print(" ")
+    for mapId, error in failed:
+        print(f"‼️   Warp failed for {mapId}: {error}")
+    print(f"‼️   {len(failed)} plates failed to warp, see `{errorFile}`. Rerun `warp-plates` to retry them; finished plates will be skipped.")
+
+def warpPlates():
+
+    gdal.UseExceptions()
+    start, started = time.monotonic(), time.time()
+    files = plateFiles()
+    failed = []
+    rows = []
+
+    if args.jobs <= 1:
+        initWarpWorker(None, *memoryShare(1))
+        for file in files:
+            file, seconds, error, row = tryWarpPlate(file)
+            rows.append(row)
+            if error:
+                failed.append((os.path.splitext(file)[0], error))
+        reportWarpErrors(failed)
+        writeWarpReport(rows)
+        reportArtifacts(started)
+        reportWarpedSizes()
+        print(f"⏱️  Warping took {time.monotonic() - start:.0f}s")
+        return
+
+    # start the largest plates first so a big one
+    # isn't left running alone at the end
+
+    files = sorted(files, key=warpedSize, reverse=True)
+    jobs = min(args.jobs, len(files)) or 1
+    threads = max(1, os.cpu_count() // jobs)
+    cacheMax, warpBytes = memoryShare(jobs)
+    cacheMax = cacheMax or gdal.GetCacheMax() // jobs
+    print(f"Warping {len(files)} plates in {jobs} processes ({threads} GDAL threads and {cacheMax // 2**20}MB cache each)...")
+
+    # a plate that crashes its worker breaks the pool and takes the
+    # plates still running or pending with it; those are retried one at
+    # a time in their own pool, so only the plate at fault is given up on
+
+    def warpedPlate(file):
+        return f'./tmp/warped/{os.path.splitext(file)[0]}-warped.tif'
+
+    def runPool(files, jobs, isolated):
+        lost = []
+        with ProcessPoolExecutor(max_workers=jobs, initializer=initWarpWorker, initargs=(threads, cacheMax, warpBytes)) as pool:
+            futures = {pool.submit(tryWarpPlate, file): file for file in files}
+            for future, file in futures.items():
+                try:
+                    file, seconds, error, row = future.result()
+                    rows.append(row)
+                except BrokenProcessPool as e:
+
+                    # a plate lost with its worker may have left partial
+                    # output, which has no record of its inputs
+
+                    if not os.path.isfile(warpedPlate(file)+'.inputs.json'):
+                        discardArtifact(warpedPlate(file))
+                    logWarp('lost', os.path.splitext(file)[0], error=repr(e))
+                    if not isolated:
+                        lost.append(file)
+                        continue
+                    error = f'worker crashed: {e!r}'
+                if error:
+                    failed.append((os.path.splitext(file)[0], error))
+                else:
+                    print(f"✔️  Warped {file} in {seconds:.0f}s")
+        return lost
+
+    lost = runPool(files, jobs, isolated=False)
+    for file in lost:
+        runPool([file], 1, isolated=True)
+
+    reportWarpErrors(failed)
+    writeWarpReport(rows)
+    reportArtifacts(started)
+    reportWarpedSizes()
+    print(f"⏱️  Warping took {time.monotonic() - start:.0f}s")
 
 #########################################
 #####                               #####
@@ -335,11 +2087,220 @@ def warpPlates():
 #####                               #####
 #########################################
 
+def plateMapId(plate):
+
+    # map ID of a warped plate, or of its seamline source
+
+    return re.sub(r'(-warped\.tif|\.vrt)$', '', os.path.basename(plate))
+
+def plateFootprints(plates):
+
+    # transformed mask of each plate in EPSG:3857,
+    # or None for a plate without one
+
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    footprints = []
+    for plate in plates:
+        if not os.path.isfile(f'./tmp/annotations/transformed/{plateMapId(plate)}-transformed.geojson'):
+            footprints.append(None)
+            continue
+        footprints.append(geom.transform(readCutline(plateMapId(plate)),
+                                         lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1]))))
+    return footprints
+
+def seamlines(footprints):
+
+    # clip each footprint by the union of the footprints drawn
+    # over it (later in the list), found with an STRtree, so the
+    # clipped footprints don't overlap. a plate without a
+    # footprint is left whole and can't clip the others
+
+    known = [i for i, f in enumerate(footprints) if f is not None]
+    tree = geom.STRtree([footprints[i] for i in known])
+    query, hit = tree.query([footprints[i] for i in known], predicate='intersects')
+    above = {}
+    for q, h in zip(query, hit):
+        if known[h] > known[q]:
+            above.setdefault(known[q], []).append(footprints[known[h]])
+    return [f if i not in above else geom.difference(f, geom.union_all(above[i]))
+            for i, f in enumerate(footprints)]
+
+def seamSources(plates):
+
+    # a warped VRT per plate that only shows its clipped footprint,
+    # read on the plate's own pixel grid with nearest neighbour so
+    # pixels are copied unchanged; hidden plates are left out
+
+    os.makedirs('tmp/seams', exist_ok=True)
+    footprints = plateFootprints(plates)
+    clipped = seamlines(footprints)
+    sources = []
+    for plate, footprint, seam in zip(plates, footprints, clipped):
+        if footprint is None:
+            sources.append(plate)
+            continue
+        if geom.is_empty(seam) or geom.area(seam) == 0:
+            continue
+        mapId = plateMapId(plate)
+        geoTransform = gdal.Open(plate).GetGeoTransform()
+        source = f'tmp/seams/{mapId}.vrt'
+        gdal.Warp(source, plate, options=gdal.WarpOptions(
+            format='VRT',
+            dstSRS='EPSG:3857',
+            xRes=geoTransform[1],
+            yRes=-geoTransform[5],
+            targetAlignedPixels=True,
+            resampleAlg='near',
+            dstAlpha=True,
+            cropToCutline=True,
+            **cutlineOptions(mapId, seam, 'EPSG:3857')
+        ))
+        if gdal.VSIStatL(f'/vsimem/{mapId}-cutline.geojson') is not None:
+            gdal.Unlink(f'/vsimem/{mapId}-cutline.geojson')
+        sources.append(source)
+    known = [f for f in footprints if f is not None]
+    overlap = sum(geom.area(known)) - sum(geom.area([c for c, f in zip(clipped, footprints) if f is not None]))
+    print(f'✂️  Clipped plates along seamlines: {len(plates) - len(sources)} hidden plates left out, '
+          f'{overlap / max(sum(geom.area(known)), 1):.0%} of plate area was overlap')
+    return sources
+
+# `--materialize` reads the mosaic in windows of this many pixels
+# square, a multiple of the 512px blocks they are written to
+
+MOSAIC_WINDOW = 2048
+
+# the mosaic VRT opened once by each `--materialize` worker
+
+mosaicSource = None
+
+def materializeOptions():
+
+    # COG creation options of `tmp/mosaic.tif`: those of the
+    # `--warp-profile`, or DEFLATE for legacy plates
+
+    return WARP_PROFILES.get(args.warpProfile, WARP_PROFILES['cog-deflate'])
+
+def mosaicWindows(mosaic, size):
+
+    # windows of the mosaic that fall in the extent of at least one
+    # of its sources, row by row; the rest of the file stays sparse
+
+    x0, pixelWidth, _, y0, _, pixelHeight = mosaic.GetGeoTransform()
+    width, height = mosaic.RasterXSize, mosaic.RasterYSize
+    covered = np.zeros((math.ceil(height / size), math.ceil(width / size)), dtype=bool)
+    for f in mosaic.GetFileList()[1:]:
+        source = gdal.Open(f)
+        sx, sw, _, sy, _, sh = source.GetGeoTransform()
+        left, right = sorted([(sx - x0) / pixelWidth, (sx + sw * source.RasterXSize - x0) / pixelWidth])
+        top, bottom = sorted([(sy - y0) / pixelHeight, (sy + sh * source.RasterYSize - y0) / pixelHeight])
+        covered[max(int(top) // size, 0):int(bottom) // size + 1, max(int(left) // size, 0):int(right) // size + 1] = True
+    return [(int(c) * size, int(r) * size, min(size, width - int(c) * size), min(size, height - int(r) * size))
+            for r, c in np.argwhere(covered)]
+
+def initMosaicWorker(threads, cacheMax):
+    global mosaicSource
+    initWarpWorker(threads, cacheMax)
+    mosaicSource = gdal.Open('tmp/mosaic.vrt')
+
+def readMosaicWindow(window):
+
+    # RGB and alpha of one window of the mosaic, band after band, or
+    # None where no plate has pixels; plus the bytes read for it.
+    # legacy and seamline mosaics have an alpha band, COG plates
+    # a mask
+
+    read = processStats().get('read_bytes', 0)
+    if mosaicSource.RasterCount == 4:
+        alpha = mosaicSource.GetRasterBand(4).ReadRaster(*window)
+    else:
+        alpha = mosaicSource.GetRasterBand(1).GetMaskBand().ReadRaster(*window)
+    data = None
+    if np.frombuffer(alpha, dtype=np.uint8).any():
+        data = mosaicSource.ReadRaster(*window, band_list=[1, 2, 3]) + alpha
+    return window, data, processStats().get('read_bytes', 0) - read
+
+def materializeMosaic():
+
+    # copy `tmp/mosaic.vrt` into `tmp/mosaic.tif`, a COG with a full
+    # overview pyramid, so `create-xyz` reads one file at the level
+    # it needs instead of compositing 0.1m plates for every tile.
+    # windows are read by `--jobs` processes and written here
+
+    started = time.time()
+    options = materializeOptions()
+    inputs = {'mosaic': artifactHash('tmp/mosaic.vrt'), 'options': hashJSON(options)}
+    reuse, reason = checkArtifact('tmp/mosaic.tif', inputs)
+    if reuse:
+        reportArtifacts(started)
+        print(f'⏭️   Skipping `tmp/mosaic.tif`, {reason}')
+        return
+
+    print(f'➡️  Materializing the mosaic into `tmp/mosaic.tif` ({reason})')
+    discardArtifact('tmp/mosaic.tif')
+    start = time.monotonic()
+    before = processStats()
+    threads = gdal.GetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    mosaic = gdal.Open('tmp/mosaic.vrt')
+    width, height = mosaic.RasterXSize, mosaic.RasterYSize
+    build = 'tmp/mosaic-build.tif'
+    out = gdal.GetDriverByName('GTiff').Create(build, width, height, 4, gdal.GDT_Byte, options=[
+        'TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=LZW', 'SPARSE_OK=TRUE',
+        'BIGTIFF=YES', 'PHOTOMETRIC=RGB', 'ALPHA=YES', f'NUM_THREADS={threads}'])
+    out.SetGeoTransform(mosaic.GetGeoTransform())
+    out.SetProjection(mosaic.GetProjection())
+
+    # at most two windows per process wait to be written,
+    # so a slow writer doesn't pile them up in memory
+
+    windows = mosaicWindows(mosaic, MOSAIC_WINDOW)
+    jobs = max(1, min(args.jobs, len(windows)))
+    read = written = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initMosaicWorker,
+                             initargs=(max(1, os.cpu_count() // jobs), gdal.GetCacheMax() // jobs)) as pool:
+        pending = []
+        for window in windows + [None] * (2 * jobs):
+            if window is not None:
+                pending.append(pool.submit(readMosaicWindow, window))
+            if pending and (window is None or len(pending) > 2 * jobs):
+                window, data, bytesRead = pending.pop(0).result()
+                read += bytesRead
+                if data is not None:
+                    out.WriteRaster(*window, data)
+                    written += 1
+    print(f"   {written} of {len(windows)} windows had pixels, read in {jobs} processes in {time.monotonic() - start:.0f}s")
+
+    # overviews down to a single 256px tile, averaged with GDAL's
+    # threads; the COG driver then copies them as they are
+
+    step = time.monotonic()
+    levels = [2 ** i for i in range(1, max(1, math.ceil(math.log2(max(width, height) / 256))) + 1)]
+    gdal.SetConfigOption('GDAL_NUM_THREADS', threads)
+    out.BuildOverviews('AVERAGE', levels)
+    out = None
+    print(f"   {len(levels)} overview levels built in {time.monotonic() - step:.0f}s")
+
+    step = time.monotonic()
+    gdal.Translate('tmp/mosaic.tif', build, options=gdal.TranslateOptions(
+        format='COG',
+        bandList=[1, 2, 3],
+        maskBand=4,
+        creationOptions=options + [f'NUM_THREADS={threads}']
+    ))
+    os.remove(build)
+    recordArtifact('tmp/mosaic.tif', inputs, reason)
+    after = processStats()
+    print(f"   COG written in {time.monotonic() - step:.0f}s")
+    print(f"⏱️  Materializing took {time.monotonic() - start:.0f}s, "
+          f"read {(read + after.get('read_bytes', 0) - before.get('read_bytes', 0)) / 2**20:.0f}MB, "
+          f"wrote {(after.get('write_bytes', 0) - before.get('write_bytes', 0)) / 2**20:.0f}MB; "
+          f"`tmp/mosaic.tif` is {os.path.getsize('tmp/mosaic.tif') / 2**20:.0f}MB")
+    reportArtifacts(started)
+
 def mosaicPlates():
 
     # define vrt options and orderFile exist variable
 
-    vrtOptions = gdal.BuildVRTOptions(
+    vrtSettings = dict(
         resolution = 'highest',
         outputSRS = 'EPSG:3857',
         separate = False,
@@ -348,11 +2309,7 @@ def mosaicPlates():
     orderFile = os.path.exists("tmp/sort-order.txt")
 
     if orderFile == True:
-        platesForMosaic = open("tmp/sort-order.txt", "r")
-        path = "tmp/warped/"
-        print('➡️  Beginning to create VRT')
-        gdal.BuildVRT('tmp/mosaic.vrt', platesForMosaic, options=vrtOptions)
-        print('🎉 Created the VRT. You can now run the final command, `create-xyz`!')
+        platesForMosaic = [l.strip() for l in open("tmp/sort-order.txt", "r") if l.strip()]
 
     else:
         platesForMosaic = []
@@ -374,11 +2331,38 @@ def mosaicPlates():
         for f in sortedPlates:
             platesForMosaic.append(f[0])
 
-        print('➡️  Beginning to create VRT')
-
-        gdal.BuildVRT('tmp/mosaic.vrt', platesForMosaic, options=vrtOptions)
-
-        print('🎉 Completed creating the VRT. You can now run the final command, `create-xyz`!')
+    # plates from a COG `--warp-profile` have RGB bands and a mask,
+    # so 0 is only treated as nodata for legacy RGBA plates; seamline
+    # sources are RGBA whatever the plates are
+
+    if platesForMosaic and gdal.Open(platesForMosaic[0]).RasterCount == 3 and not args.seamlines:
+        del vrtSettings['srcNodata']
+
+    # the mosaic is rebuilt only if the plates, their
+    # order or what they were built from changed
+
+    started = time.time()
+    inputs = {
+        'plates': hashJSON([[plate, artifactHash(plate)] for plate in platesForMosaic]),
+        'options': hashJSON(vrtSettings),
+        'seamlines': args.seamlines
+    }
+    reuse, reason = checkArtifact('tmp/mosaic.vrt', inputs)
+    if reuse:
+        reportArtifacts(started)
+        print(f'⏭️   Skipping `tmp/mosaic.vrt`, {reason}')
+    else:
+        print(f'➡️  Beginning to create VRT ({reason})')
+        if args.seamlines:
+            platesForMosaic = seamSources(platesForMosaic)
+        gdal.BuildVRT('tmp/mosaic.vrt', platesForMosaic, options=gdal.BuildVRTOptions(**vrtSettings))
+        recordArtifact('tmp/mosaic.vrt', inputs, reason)
+        reportArtifacts(started)
+        print('🎉 Completed creating the VRT.')
+
+    if args.materialize:
+        materializeMosaic()
+    print('You can now run the final command, `create-xyz`!')
 
     return
 
@@ -390,23 +2374,962 @@ def mosaicPlates():
 #####                               #####
 #########################################
 
+def tilingSource():
+
+    # `tmp/mosaic.tif` if it was materialized from the current
+    # `tmp/mosaic.vrt`, otherwise the VRT itself
+
+    if os.path.isfile('tmp/mosaic.tif.inputs.json') and os.path.isfile('tmp/mosaic.vrt'):
+        if readJSONFile('tmp/mosaic.tif.inputs.json')['inputs'].get('mosaic') == artifactHash('tmp/mosaic.vrt'):
+            return 'tmp/mosaic.tif'
+        print('⚠️  `tmp/mosaic.tif` is older than `tmp/mosaic.vrt`, tiling the VRT; rerun `mosaic-plates --materialize` to update it')
+    return 'tmp/mosaic.vrt'
+
+def writeXYZReport(row):
+
+    # append one `create-xyz` run to `tmp/xyz-report.csv`,
+    # so runs from the VRT and the COG, or of each tiler, can be compared
+
+    report = 'tmp/xyz-report.csv'
+    rows = pd.DataFrame([row])
+    if os.path.isfile(report):
+        rows = pd.concat([pd.read_csv(report), rows])
+    rows.to_csv(report, index=False)
+
+# the tiles of `--tiler native` are 256px, cut from these sources,
+# opened once in each worker
+
+TILE_SIZE = 256
+tileSources = None
+
+def tileBox(zoom, x, y):
+
+    # EPSG:3857 bounds of XYZ tiles, for single tiles or arrays
+
+    origin = WEB_MERCATOR_RESOLUTION * 256 / 2
+    size = tileResolution(zoom) * TILE_SIZE
+    return x * size - origin, origin - (y + 1) * size, (x + 1) * size - origin, origin - y * size
+
+def tilePath(zoom, x, y):
+    return f'output/tiles/{zoom}/{x}/{y}.{TILE_FORMATS[args.tileFormat][0]}'
+
+class TileStore:
+
+    # where `--tiler native` keeps its tiles: PNG files in
+    # `output/tiles`, or, with `--tile-archive`, an MBTiles database
+    # that stores each distinct tile once, keyed by its sha256
+
+    def __init__(self, file=None):
+        self.file = file
+        self.db = None
+        self.lock = threading.Lock()
+        self.changes = 0
+        if file:
+            self.db = sqlite3.connect(file, check_same_thread=False)
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+                                                PRIMARY KEY (zoom_level, tile_column, tile_row));
+                CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+                CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+                CREATE VIEW IF NOT EXISTS tiles AS SELECT zoom_level, tile_column, tile_row, tile_data
+                    FROM map JOIN images ON images.tile_id = map.tile_id;
+            ''')
+
+    def row(self, key):
+
+        # MBTiles rows count from the bottom (TMS)
+
+        zoom, x, y = key
+        return zoom, x, (1 << zoom) - 1 - y
+
+    def isEmpty(self):
+        if not self.db:
+            return not os.path.isdir('output/tiles/13')
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM map LIMIT 1').fetchone() is None
+
+    def has(self, key):
+        if not self.db:
+            return os.path.isfile(tilePath(*key))
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                   self.row(key)).fetchone() is not None
+
+    def get(self, key):
+        if not self.db:
+            with open(tilePath(*key), 'rb') as f:
+                return f.read()
+        with self.lock:
+            return self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                   self.row(key)).fetchone()[0]
+
+    def put(self, key, data):
+
+        # store a tile, or remove it if `data` is None; files are
+        # written under a temporary name first and rows committed in
+        # batches, so an interrupted run never leaves a partial tile
+
+        if not self.db:
+            path = tilePath(*key)
+            if data is None:
+                if os.path.isfile(path):
+                    os.remove(path)
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.part', path)
+            return
+        with self.lock:
+            if data is None:
+                self.db.execute('DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', self.row(key))
+            else:
+                tileId = hashlib.sha256(data).hexdigest()
+                self.db.execute('INSERT OR IGNORE INTO images VALUES (?, ?)', (tileId, data))
+                self.db.execute('INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)', (*self.row(key), tileId))
+            self.changes += 1
+            if self.changes % 1000 == 0:
+                self.db.commit()
+
+    def setMetadata(self, metadata):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', [(k, str(v)) for k, v in metadata.items()])
+            self.db.commit()
+
+    def close(self):
+
+        # drop payloads no tile points to any more
+
+        if self.db:
+            with self.lock:
+                self.db.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+    def stats(self):
+        with self.lock:
+            tiles, stored = self.db.execute('SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM tiles').fetchone()
+            distinct, unique = self.db.execute('SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM images').fetchone()
+        return tiles, distinct, (stored or 0) - (unique or 0)
+
+# the store the native tiler writes to, set by `renderTiles`
+
+tileStore = None
+
+def sourceFootprints(sources):
+
+    # footprint of each mosaic source in EPSG:3857: its plate's mask,
+    # or its extent if it has none (seamline sources get their whole mask)
+
+    footprints = plateFootprints(sources)
+    for i, footprint in enumerate(footprints):
+        if footprint is None:
+            source = gdal.Open(sources[i])
+            x0, width, _, y0, _, height = source.GetGeoTransform()
+            footprints[i] = geom.box(x0, y0 + height * source.RasterYSize, x0 + width * source.RasterXSize, y0)
+    return np.array(footprints, dtype=object)
+
+def enumerateTiles(tree, zoom, region=None, chunk=2**20):
+
+    # tiles of `zoom` that intersect at least one footprint in `tree`,
+    # each with the footprints under it in drawing order, sorted along
+    # a Z-order curve; tile boxes are made and queried `chunk` at a time.
+    # also returns how many tiles the bbox of the footprints holds.
+    # with a `region`, every tile that intersects it is listed instead,
+    # including those no footprint covers any more
+
+    origin = WEB_MERCATOR_RESOLUTION * 256 / 2
+    size = tileResolution(zoom) * TILE_SIZE
+    x0, y0, x1, y1 = geom.total_bounds(tree.geometries if region is None else region)
+    columns = np.arange(math.floor((x0 + origin) / size), math.ceil((x1 + origin) / size))
+    rows = np.arange(math.floor((origin - y1) / size), math.ceil((origin - y0) / size))
+    step = max(1, chunk // len(columns))
+    if region is not None:
+        geom.prepare(region)
+    tiles = []
+    for first in range(0, len(rows), step):
+        x, y = [a.ravel() for a in np.meshgrid(columns, rows[first:first + step])]
+        boxes = geom.box(*tileBox(zoom, x, y))
+        if region is not None:
+            inside = geom.intersects(region, boxes)
+            x, y, boxes = x[inside], y[inside], boxes[inside]
+        tile, hit = tree.query(boxes, predicate='intersects')
+        order = np.argsort(tile, kind='stable')
+        tile, hit = tile[order], hit[order]
+        found, starts = np.unique(tile, return_index=True)
+        tiles += [(zoom, int(x[t]), int(y[t]), tuple(np.sort(under).tolist()))
+                  for t, under in zip(found, np.split(hit, starts[1:]))]
+        if region is not None:
+            tiles += [(zoom, int(x[t]), int(y[t]), ()) for t in np.setdiff1d(np.arange(len(boxes)), found)]
+
+    # the curve starts at a zoom 13 tile corner, so the tiles
+    # under any lower zoom tile come out one after another
+
+    if tiles:
+        x, y = np.array([t[1:3] for t in tiles]).T
+        shift = max(zoom - 13, 0)
+        tiles = [tiles[i] for i in np.argsort(mortonCode(x - (columns[0] >> shift << shift), y - (rows[0] >> shift << shift)), kind='stable')]
+    return tiles, len(columns) * len(rows)
+
+def initTileWorker(sources):
+    global tileSources
+    initWarpWorker(1, None)
+    gdal.SetConfigOption('GDAL_PAM_ENABLED', 'NO')
+    tileSources = [gdal.Open(s) for s in sources]
+
+def readMemFile(path):
+    f = gdal.VSIFOpenL(path, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    return data
+
+# `--tile-format`s: the file extension of their tiles and their
+# PMTiles tile type (0 where JPEG and PNG tiles are mixed)
+
+TILE_FORMATS = {
+    'png': ('png', 2),
+    'png8': ('png', 2),
+    'webp': ('webp', 4),
+    'webp-lossy': ('webp', 4),
+    'auto-jpeg': ('png', 0),
+    'auto-webp': ('webp', 4),
+}
+
+def encodeDataset(dataset, driver='PNG', options=None):
+    path = f'/vsimem/tile-{os.getpid()}-{threading.get_ident()}'
+    gdal.GetDriverByName(driver).CreateCopy(path, dataset, options=options or [])
+    data = readMemFile(path)
+    gdal.Unlink(path)
+    return data
+
+def paletteTile(pixels):
+
+    # 1-band tile with a colour table of at most 255 colours picked by
+    # median cut and dithered to, plus one fully transparent entry for
+    # pixels less than half opaque
+
+    rgb = gdal.GetDriverByName('MEM').Create('', TILE_SIZE, TILE_SIZE, 3, gdal.GDT_Byte)
+    rgb.WriteRaster(0, 0, TILE_SIZE, TILE_SIZE, pixels[:3].tobytes())
+    bands = [rgb.GetRasterBand(b) for b in [1, 2, 3]]
+    table = gdal.ColorTable()
+    gdal.ComputeMedianCutPCT(*bands, 255, table)
+    paletted = gdal.GetDriverByName('MEM').Create('', TILE_SIZE, TILE_SIZE, 1, gdal.GDT_Byte)
+    gdal.DitherRGB2PCT(*bands, paletted.GetRasterBand(1), table)
+    index = np.frombuffer(paletted.ReadRaster(), dtype=np.uint8).reshape(TILE_SIZE, TILE_SIZE).copy()
+    index[pixels[3] < 128] = 255
+    table.SetColorEntry(255, (0, 0, 0, 0))
+    paletted.GetRasterBand(1).WriteRaster(0, 0, TILE_SIZE, TILE_SIZE, index.tobytes())
+    paletted.GetRasterBand(1).SetRasterColorTable(table)
+    return paletted
+
+def encodeTile(key, pixels):
+
+    # encode a tile (pixels, bands first) in `--tile-format`; returns
+    # its bytes and the seconds it took. the `auto-` formats drop the
+    # alpha band of tiles that are opaque all over
+
+    start = time.monotonic()
+    opaque = bool((pixels[3] == 255).all())
+    quality = [f'QUALITY={args.tileQuality}']
+    driver, bands, options = {
+        'png': ('PNG', 4, []),
+        'png8': ('PNG', 1, []),
+        'webp': ('WEBP', 4, ['LOSSLESS=YES']),
+        'webp-lossy': ('WEBP', 4, quality),
+        'auto-jpeg': ('JPEG', 3, quality) if opaque else ('PNG', 4, []),
+        'auto-webp': ('WEBP', 3, quality) if opaque else ('WEBP', 4, ['LOSSLESS=YES']),
+    }[args.tileFormat]
+    if bands == 1:
+        dataset = paletteTile(pixels)
+    else:
+        dataset = gdal.GetDriverByName('MEM').Create('', TILE_SIZE, TILE_SIZE, bands, gdal.GDT_Byte)
+        dataset.WriteRaster(0, 0, TILE_SIZE, TILE_SIZE, pixels[:bands].tobytes())
+        if bands == 4:
+            dataset.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+    return key, encodeDataset(dataset, driver, options), time.monotonic() - start
+
+def readTile(key):
+
+    # pixels of a tile kept from an earlier run, bands first
+
+    path = f'/vsimem/kept-{key[0]}-{key[1]}-{key[2]}'
+    gdal.FileFromMemBuffer(path, tileStore.get(key))
+    tile = gdal.Open(path)
+    gdal.Unlink(path)
+    if tile.GetRasterBand(1).GetColorTable():
+        tile = gdal.Translate('', tile, format='MEM', rgbExpand='rgba')
+    pixels = np.frombuffer(tile.ReadRaster(), dtype=np.uint8).reshape(tile.RasterCount, TILE_SIZE, TILE_SIZE)
+    if tile.RasterCount == 4:
+        return pixels
+    return np.concatenate([np.broadcast_to(pixels[:1], (3, TILE_SIZE, TILE_SIZE)) if tile.RasterCount == 1 else pixels[:3],
+                           np.full((1, TILE_SIZE, TILE_SIZE), 255, dtype=np.uint8)])
+
+def reduceTiles(children, resampling):
+
+    # a tile from the 2x2 children under it ((dx, dy) → pixels, bands
+    # first; missing children are transparent). `average` weights each
+    # pixel by its alpha so transparent edges don't darken the colours
+
+    full = np.zeros((4, 2 * TILE_SIZE, 2 * TILE_SIZE), dtype=np.uint8)
+    for (dx, dy), pixels in children.items():
+        full[:, dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = pixels
+    if resampling == 'nearest':
+        return np.ascontiguousarray(full[:, ::2, ::2])
+    blocks = full.astype(np.uint32).reshape(4, TILE_SIZE, 2, TILE_SIZE, 2)
+    alpha = blocks[3].sum(axis=(1, 3))
+    colour = (blocks[:3] * blocks[3]).sum(axis=(2, 4))
+    reduced = np.empty((4, TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    reduced[:3] = (colour + alpha // 2) // np.maximum(alpha, 1)
+    reduced[3] = (alpha + 2) // 4
+    return reduced
+
+def renderTile(tile):
+
+    # warp only the sources under one tile into a 256px RGBA tile,
+    # averaging like gdal2tiles; returns its pixels, bands first,
+    # or None if the tile came out fully transparent. tiles are
+    # encoded apart from rendering, by `encodeTile`
+
+    zoom, x, y, under = tile
+    if not under:
+        return tile[:3], None
+    rendered = gdal.Warp('', [tileSources[i] for i in under], options=gdal.WarpOptions(
+        format='MEM',
+        dstSRS='EPSG:3857',
+        outputBounds=[float(b) for b in tileBox(zoom, x, y)],
+        width=TILE_SIZE,
+        height=TILE_SIZE,
+        resampleAlg='average',
+        dstAlpha=True
+    ))
+    if not np.frombuffer(rendered.GetRasterBand(4).ReadRaster(), dtype=np.uint8).any():
+        return tile[:3], None
+    return tile[:3], np.frombuffer(rendered.ReadRaster(), dtype=np.uint8).reshape(4, TILE_SIZE, TILE_SIZE)
+
+def writeTiles(tiles, failed):
+
+    # write-behind: tiles are stored by this thread while the workers
+    # render the next ones. a tile that came out empty is removed if
+    # an earlier run left one. if storing fails (disk full, SQLite)
+    # the error is handed to `failed` for the main thread to raise,
+    # and the queue is still emptied so nothing waits on it forever
+
+    while (tile := tiles.get()) is not None:
+        if failed:
+            continue
+        try:
+            tileStore.put(*tile)
+        except Exception as e:
+            failed.append(e)
+
+def writeVarint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def tileIds(zoom, x, y):
+
+    # PMTiles tile IDs of arrays of tiles: the tiles of all lower
+    # zooms come first, then the position along a Hilbert curve
+
+    zoom, x, y = [np.array(v, dtype=np.int64) for v in (zoom, x, y)]
+    n = np.left_shift(1, zoom)
+    ids = (n * n - 1) // 3
+    for a in range(int(zoom.max(initial=0)) - 1, -1, -1):
+        s = 1 << a
+        active = a < zoom
+        rx, ry = (x & s) > 0, (y & s) > 0
+        ids += np.where(active, ((3 * rx) ^ ry).astype(np.int64) << (2 * a), 0)
+        flip = active & ~ry & rx
+        x, y = np.where(flip, n - 1 - x, x), np.where(flip, n - 1 - y, y)
+        swap = active & ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+    return ids
+
+def pmtilesDirectory(entries):
+
+    # (tile ID, offset, length, run length) entries as a gzipped PMTiles
+    # directory: each column in turn, IDs as deltas, and an offset that
+    # follows on from the entry before written as 0
+
+    out = bytearray()
+    writeVarint(out, len(entries))
+    last = 0
+    for tileId, offset, length, run in entries:
+        writeVarint(out, tileId - last)
+        last = tileId
+    for tileId, offset, length, run in entries:
+        writeVarint(out, run)
+    for tileId, offset, length, run in entries:
+        writeVarint(out, length)
+    for i, (tileId, offset, length, run) in enumerate(entries):
+        writeVarint(out, 0 if i and offset == entries[i - 1][1] + entries[i - 1][2] else offset + 1)
+    return gzip.compress(bytes(out))
+
+def pmtilesDirectories(entries):
+
+    # the root directory has to fit in the first 16KB with the header;
+    # if all entries don't, they go in leaf directories the root points to
+
+    root = pmtilesDirectory(entries)
+    leafSize = 4096
+    leaves = b''
+    while len(root) > 16384 - 127:
+        rootEntries, leaves = [], b''
+        for i in range(0, len(entries), leafSize):
+            leaf = pmtilesDirectory(entries[i:i + leafSize])
+            rootEntries.append((entries[i][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = pmtilesDirectory(rootEntries)
+        leafSize *= 2
+    return root, leaves
+
+def writePMTiles(file, metadata, bounds):
+
+    # copy the tiles of `tileStore` into a PMTiles v3 archive: tile data
+    # in tile ID order, each distinct tile once, and runs of identical
+    # tiles in a row (solid paper, say) as a single directory entry
+
+    with tileStore.lock:
+        rows = tileStore.db.execute('SELECT zoom_level, tile_column, tile_row, tile_id FROM map').fetchall()
+    zoom, x, row = np.array([r[:3] for r in rows], dtype=np.int64).reshape(-1, 3).T
+    hashes = [r[3] for r in rows]
+    ids = tileIds(zoom, x, (1 << zoom) - 1 - row)
+    order = np.argsort(ids, kind='stable')
+
+    entries = []
+    stored = {}
+    length = 0
+    with open(file + '.data', 'wb') as data:
+        for i in order:
+            tileId, key = int(ids[i]), hashes[i]
+            if key not in stored:
+                with tileStore.lock:
+                    payload = tileStore.db.execute('SELECT tile_data FROM images WHERE tile_id = ?', (key,)).fetchone()[0]
+                stored[key] = (length, len(payload))
+                data.write(payload)
+                length += len(payload)
+            offset, size = stored[key]
+            if entries and entries[-1][1] == offset and entries[-1][0] + entries[-1][3] == tileId:
+                entries[-1] = entries[-1][:3] + (entries[-1][3] + 1,)
+            else:
+                entries.append((tileId, offset, size, 1))
+
+    root, leaves = pmtilesDirectories(entries)
+    meta = gzip.compress(json.dumps(metadata).encode())
+    west, south, east, north = [round(v * 1e7) for v in bounds]
+    minZoom, maxZoom = (int(zoom.min()), int(zoom.max())) if len(zoom) else (13, args.maxZoom)
+    header = struct.pack('<7sB11Q6B4iB2i', b'PMTiles', 3,
+                         127, len(root), 127 + len(root), len(meta), 127 + len(root) + len(meta), len(leaves),
+                         127 + len(root) + len(meta) + len(leaves), length,
+                         len(ids), len(entries), len(stored),
+                         1, 2, 1, TILE_FORMATS[args.tileFormat][1], minZoom, maxZoom,
+                         west, south, east, north,
+                         minZoom, (west + east) // 2, (south + north) // 2)
+    with open(file + '.part', 'wb') as f:
+        f.write(header + root + meta + leaves)
+        with open(file + '.data', 'rb') as data:
+            shutil.copyfileobj(data, f)
+    os.remove(file + '.data')
+    os.replace(file + '.part', file)
+
+def finishTileset(bounds):
+
+    # describe the tiles in `tileset.json` (and the archive's metadata):
+    # zooms, bounds, and with `--tile-archive` where the archive is
+
+    tileset = readJSONFile('output/tileset.json') if os.path.isfile('output/tileset.json') else {}
+    extension, tileType = TILE_FORMATS[args.tileFormat]
+    tileset.update(maxzoom=str(args.maxZoom), bounds=[round(v, 6) for v in bounds], format=extension)
+    tileset['tiles'] = [re.sub(r'\{y\}\.\w+$', '{y}.' + extension, t) for t in tileset.get('tiles', [])]
+    if args.tileArchive == 'pmtiles':
+
+        # the same folder as the XYZ tiles, read with the PMTiles protocol
+
+        tiles = [t if t.endswith('.pmtiles') else 'pmtiles://' + t.split('/tiles/{z}')[0] + '/tiles.pmtiles'
+                 for t in tileset.get('tiles', [])]
+        tileset.update(tiles=tiles or ['pmtiles://tiles.pmtiles'])
+    if os.path.isfile('output/tileset.json'):
+        with open('output/tileset.json', 'w') as f:
+            f.write(json.dumps(tileset, indent=2))
+    if tileStore.db is None:
+        return
+    west, south, east, north = bounds
+    metadata = {
+        'name': tileset.get('name', ''),
+        'description': tileset.get('description', ''),
+        'attribution': tileset.get('attribution', ''),
+        'version': tileset.get('version', '1.0.0'),
+        'type': 'overlay',
+        'format': extension,
+        'minzoom': 13,
+        'maxzoom': args.maxZoom,
+        'bounds': f'{west},{south},{east},{north}',
+        'center': f'{(west + east) / 2},{(south + north) / 2},13'
+    }
+    tileStore.setMetadata(metadata)
+    tiles, distinct, saved = tileStore.stats()
+    print(f"🗃️  {tiles} tiles stored as {distinct} distinct payloads, {saved / 2**20:.0f}MB saved by storing repeats once")
+    if args.tileArchive == 'pmtiles':
+        writePMTiles('output/tiles.pmtiles', metadata, bounds)
+        print(f"🗃️  Wrote `output/tiles.pmtiles` ({os.path.getsize('output/tiles.pmtiles') / 2**20:.0f}MB)")
+    else:
+        print(f"🗃️  Wrote `{tileStore.file}` ({os.path.getsize(tileStore.file) / 2**20:.0f}MB)")
+
+def renderPyramid(pool, tiles, total, encode, resume, retile):
+
+    # `--pyramid`: render only the `--max-zoom` `tiles` from the sources
+    # and build each tile below from its four children as soon as the last
+    # of them is done. tiles come back in Z-order, so few wait for their
+    # siblings. with `retile` the children outside `tiles` are read back
+    # from the tile store
+
+    workers = args.tileWorkers
+    start = time.monotonic()
+
+    # how many children each tile of the lower zooms waits for
+
+    remaining = {}
+    waiting = {}
+    level = [t[:3] for t in tiles]
+    for zoom in range(args.maxZoom, 13, -1):
+        parents = {}
+        for z, x, y in level:
+            parents[(z - 1, x >> 1, y >> 1)] = parents.get((z - 1, x >> 1, y >> 1), 0) + 1
+        if retile:
+            level = set(level)
+            for z, x, y in parents:
+                for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+                    child = (zoom, 2 * x + dx, 2 * y + dy)
+                    if child not in level and tileStore.has(child):
+                        waiting.setdefault((z, x, y), {})[(dx, dy)] = 'kept'
+        remaining.update(parents)
+        level = parents
+    built = {zoom: 0 for zoom in range(13, args.maxZoom + 1)}
+    kept = 0
+    pending = []
+
+    def buildTile(key, children):
+        if resume and tileStore.has(key):
+            return 'kept'
+        if not children:
+            encode(key, None)
+            return None
+        zoom, x, y = key
+        pixels = reduceTiles({(dx, dy): readTile((zoom + 1, 2 * x + dx, 2 * y + dy)) if isinstance(child, str) else child
+                              for (dx, dy), child in children.items()}, args.pyramidResampling)
+        if not pixels[3].any():
+            encode(key, None)
+            return None
+        encode(key, pixels)
+        built[zoom] += 1
+        return pixels
+
+    def finish(key, result):
+
+        # hand a finished tile (pixels, 'kept', or None if empty) to its
+        # parent, building the parent once all its children are in
+
+        zoom, x, y = key
+        while zoom > 13:
+            parent = (zoom - 1, x >> 1, y >> 1)
+            children = waiting.setdefault(parent, {})
+            if result is not None:
+                children[(x & 1, y & 1)] = result
+            remaining[parent] -= 1
+            if remaining[parent]:
+                return
+            del remaining[parent], waiting[parent]
+            result = buildTile(parent, children)
+            zoom, x, y = parent
+
+    def collect():
+        key, pixels = pending.pop(0).result()
+        encode(key, pixels)
+        if pixels is not None:
+            built[key[0]] += 1
+        finish(key, pixels)
+
+    for tile in tiles:
+        if resume and tileStore.has(tile[:3]):
+            kept += 1
+            finish(tile[:3], 'kept')
+            continue
+        pending.append(pool.submit(renderTile, tile))
+        while len(pending) > 2 * workers:
+            collect()
+    while pending:
+        collect()
+
+    print(f"   🧱 zoom {args.maxZoom}: {len(tiles)} of {total} tiles in the bbox {'are in the retiled area' if retile else 'touch a plate'}, "
+          f"{kept} kept from before, {built[args.maxZoom]} rendered from the plates")
+    for zoom in range(args.maxZoom - 1, 12, -1):
+        print(f"   🧱 zoom {zoom}: {built[zoom]} built from their children")
+    print(f"   Pyramid built in {time.monotonic() - start:.0f}s")
+    return sum(built.values())
+
+def writeTiledPlates(sources):
+
+    # the plates the tiles in `output/tiles` were cut from, with their
+    # masks and hashes, so `--retile` can tell which changed since
+
+    mapIds = [plateMapId(s) for s in sources]
+    mapIds = [m for m in mapIds if os.path.isfile(f'./tmp/annotations/transformed/{m}-transformed.geojson')]
+    pyogrio.raw.write('tmp/tiled-plates.geojson', geom.to_wkb([readCutline(m) for m in mapIds]),
+                      [np.array(mapIds, dtype=object),
+                       np.array([artifactHash(f'tmp/warped/{m}-warped.tif') for m in mapIds], dtype=object)],
+                      ['allmapsMapID', 'hash'], driver='GeoJSON', geometry_type='Unknown', crs='EPSG:4326')
+
+def changedRegion(sources, footprints):
+
+    # the map IDs whose plate changed since the tiles were cut (or those
+    # in `--map-ids`), and the union of their old and new footprints in
+    # EPSG:3857; a plate that is gone only has its old footprint
+
+    meta, fids, geometry, fieldData = pyogrio.raw.read('tmp/tiled-plates.geojson')
+    fields = list(meta['fields'])
+    mapIds = fieldData[fields.index('allmapsMapID')]
+    old = dict(zip(mapIds, geom.from_wkb(geometry)))
+    hashes = dict(zip(mapIds, fieldData[fields.index('hash')]))
+    new = {plateMapId(s): f for s, f in zip(sources, footprints)}
+    if args.mapIds:
+        changed = set(args.mapIds)
+    else:
+        changed = {m for m in new if hashes.get(m) != artifactHash(f'tmp/warped/{m}-warped.tif')} | (set(old) - set(new))
+    transformer = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+    parts = [geom.transform(old[m], lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1])))
+             for m in changed if m in old] + [new[m] for m in changed if m in new]
+    return sorted(changed), geom.union_all(parts) if parts else None
+
+def renderTiles(source):
+
+    # cut the tiles of every zoom that intersect a plate, each from only
+    # the sources under it, in `--tile-workers` processes. tiles already
+    # stored by a run with the same inputs are kept, so an interrupted
+    # run picks up where it stopped. with `--retile` only the tiles over
+    # plates that changed since the last run are cut again.
+    # `tmp/tiles.inputs.json` is only written once a run finishes; while
+    # one runs, `tmp/tiles.pending.json` says whether the stored tiles
+    # all came from its inputs (it began with an empty store, or from a
+    # run with the same inputs) and so may be kept if it is interrupted
+
+    global tileStore
+    sources = gdal.Open('tmp/mosaic.vrt').GetFileList()[1:]
+    footprints = sourceFootprints(sources)
+    tree = geom.STRtree(footprints)
+    materialized = source == 'tmp/mosaic.tif'
+    inputs = {
+        'mosaic': artifactHash(source),
+        'tiles': hashJSON([TILE_SIZE, 'average', 'png'] + (['pyramid', args.pyramidResampling] if args.pyramid else [])
+                          + ([args.tileArchive] if args.tileArchive != 'none' else [])
+                          + ([args.tileFormat, args.tileQuality] if args.tileFormat != 'png' else []))
+    }
+    tileStore = TileStore({'none': None, 'mbtiles': 'output/tiles.mbtiles', 'pmtiles': 'tmp/tiles.mbtiles'}[args.tileArchive])
+    previous = readJSONFile('tmp/tiles.inputs.json')['inputs'] if os.path.isfile('tmp/tiles.inputs.json') else None
+    pending = readJSONFile('tmp/tiles.pending.json') if os.path.isfile('tmp/tiles.pending.json') else {}
+    region = None
+    if args.retile:
+
+        # retiling only makes sense over tiles cut the same way. an
+        # interrupted `--retile` left the tiles outside its area as
+        # the finished run before it cut them
+
+        previous = previous or pending.get('retiling')
+        if not os.path.isfile('tmp/tiled-plates.geojson') or not previous or previous['tiles'] != inputs['tiles']:
+            print('‼️   The tiles were not cut by a finished run with these tile options, run `create-xyz` without `--retile` first')
+            tileStore.close()
+            return None
+        changed, region = changedRegion(sources, footprints)
+        if region is None:
+            print('✅   No plate changed since the tiles were cut')
+            tileStore.close()
+            return None
+        print(f"🔁 Retiling around {len(changed)} changed plates: {', '.join(changed)}")
+        resume = False
+        reason = f"{', '.join(changed)} retiled"
+        started = {'inputs': inputs, 'resumable': False, 'retiling': previous}
+    else:
+        resume = previous == inputs or (pending.get('inputs') == inputs and pending['resumable'])
+        reason = 'inputs unchanged' if resume else 'not built yet' if tileStore.isEmpty() else 'inputs changed'
+        started = {'inputs': inputs, 'resumable': reason != 'inputs changed'}
+        if reason == 'inputs changed':
+            print('⚠️  The tiles were made from other inputs, so every tile is rendered again')
+    writeJSONFile('tmp/tiles.pending.json', started)
+    discardArtifact('tmp/tiles')
+
+    def listTiles(zoom):
+        tiles, total = enumerateTiles(tree, zoom, region)
+        if materialized:
+            tiles = [t[:3] + ((0,) if t[3] else (),) for t in tiles]
+        return tiles, total
+
+    workers = args.tileWorkers
+    written = queue.Queue(maxsize=4 * workers)
+    failed = []
+    writer = threading.Thread(target=writeTiles, args=(written, failed))
+    writer.start()
+
+    def store(key, data):
+        if failed:
+            raise failed[0]
+        written.put((key, data))
+    counts = []
+
+    # tiles are encoded by `--encode-workers` threads (GDAL lets go of
+    # the GIL while it compresses), apart from the processes rendering
+    # them; per zoom: tiles, bytes and seconds spent encoding
+
+    encoder = ThreadPoolExecutor(max_workers=args.encodeWorkers)
+    encoding = []
+    sizes = {zoom: [0, 0, 0.0] for zoom in range(13, args.maxZoom + 1)}
+
+    def drain(limit=0):
+        while encoding and (len(encoding) > limit or encoding[0].done()):
+            key, data, seconds = encoding.pop(0).result()
+            store(key, data)
+            sizes[key[0]][0] += 1
+            sizes[key[0]][1] += len(data)
+            sizes[key[0]][2] += seconds
+
+    def encode(key, pixels):
+        if pixels is None:
+            store(key, None)
+        else:
+            encoding.append(encoder.submit(encodeTile, key, pixels))
+        drain(4 * args.encodeWorkers)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initTileWorker,
+                                 initargs=([source] if materialized else sources,)) as pool:
+            if args.pyramid:
+                counts.append(renderPyramid(pool, *listTiles(args.maxZoom), encode, resume, args.retile))
+            for zoom in [] if args.pyramid else range(13, args.maxZoom + 1):
+                start = time.monotonic()
+                tiles, total = listTiles(zoom)
+                todo = [t for t in tiles if not (resume and tileStore.has(t[:3]))]
+                empty = 0
+
+                # at most two tiles per worker wait to be collected
+
+                pending = []
+                for tile in todo + [None] * (2 * workers):
+                    if tile is not None:
+                        pending.append(pool.submit(renderTile, tile))
+                    if pending and (tile is None or len(pending) > 2 * workers):
+                        key, pixels = pending.pop(0).result()
+                        encode(key, pixels)
+                        if pixels is None:
+                            empty += 1
+                counts.append(len(todo) - empty)
+                print(f"   🧱 zoom {zoom}: {len(tiles)} of {total} tiles in the bbox {'are in the retiled area' if region is not None else 'touch a plate'}, "
+                      f"{len(tiles) - len(todo)} kept from before, {len(todo) - empty} rendered, "
+                      f"{empty} empty, in {time.monotonic() - start:.0f}s")
+        drain()
+    finally:
+        encoder.shutdown()
+        written.put(None)
+        writer.join()
+    if failed:
+        raise failed[0]
+
+    print(f"   Encoded as {args.tileFormat}:")
+    for zoom, (tiles, size, seconds) in sizes.items():
+        if tiles:
+            print(f"   🧱 zoom {zoom}: {tiles} tiles, {size / 2**20:.1f}MB ({size / tiles / 1024:.1f}KB a tile), "
+                  f"{seconds * 1000 / tiles:.1f}ms a tile to encode")
+
+    # the tiles now match the current plates
+
+    x0, y0, x1, y1 = geom.total_bounds(footprints)
+    west, south = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True).transform(x0, y0)
+    east, north = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True).transform(x1, y1)
+    finishTileset([west, south, east, north])
+    tileStore.close()
+    recordArtifact('tmp/tiles', inputs, reason, reused=resume)
+    os.remove('tmp/tiles.pending.json')
+    writeTiledPlates(sources)
+    return {
+        'tiles': sum(counts),
+        'tileMB': round(sum(size for tiles, size, seconds in sizes.values()) / 2**20, 1),
+        'encodeSeconds': round(sum(seconds for tiles, size, seconds in sizes.values()), 1)
+    }
+
+def processUsage():
+
+    # CPU time and disk blocks of this process and its finished children
+
+    usage = [resource.getrusage(who) for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    return {k: sum(getattr(u, k) for u in usage) for k in ['ru_utime', 'ru_stime', 'ru_inblock', 'ru_oublock']}
+
 def createXYZ():
     
     path="./"
+    source = tilingSource()
     cmd = [
-        "gdal2tiles.py", "--xyz", "-z", "13-20", "--exclude", "--processes", "4", "tmp/mosaic.vrt", "output/tiles"
+        "gdal2tiles.py", "--xyz", "-z", f"13-{args.maxZoom}", "--exclude", "--processes", str(args.tileWorkers), source, "output/tiles"
     ]
 
-    print("Beginning to generate XYZ tiles...")
-    subprocess.run(
-        cmd,
-        cwd=path
-    )
+    print(f"Beginning to generate XYZ tiles from `{source}` with {args.tiler}...")
+    gdal.UseExceptions()
+    start = time.monotonic()
+    before = processUsage()
+    if args.tiler == 'native':
+        tiles = renderTiles(source) or {}
+    else:
+        if args.tileArchive != 'none' or args.pyramid or args.retile or args.tileFormat != 'png':
+            print('⚠️  `--tile-archive`, `--pyramid`, `--retile` and `--tile-format` need `--tiler native`; gdal2tiles writes RGBA PNGs to `output/tiles` as before')
+        subprocess.run(
+            cmd,
+            cwd=path
+        )
+
+        # the size of its tileset, to compare the native tiler's formats with
+
+        pngs = glob.glob('output/tiles/*/*/*.png')
+        tiles = {'tiles': len(pngs), 'tileMB': round(sum(os.path.getsize(p) for p in pngs) / 2**20, 1)}
+
+    # block counts are in 512-byte units and only
+    # count reads that missed the page cache
+
+    after = processUsage()
+    row = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'tiler': args.tiler,
+        'source': source,
+        'zooms': f'13-{args.maxZoom}',
+        'format': args.tileFormat if args.tiler == 'native' else 'png',
+        **tiles,
+        'seconds': round(time.monotonic() - start, 1),
+        'cpuSeconds': round(after['ru_utime'] + after['ru_stime'] - before['ru_utime'] - before['ru_stime'], 1),
+        'readMB': round((after['ru_inblock'] - before['ru_inblock']) * 512 / 2**20, 1),
+        'writtenMB': round((after['ru_oublock'] - before['ru_oublock']) * 512 / 2**20, 1),
+    }
+    writeXYZReport(row)
+    print(f"⏱️  Tiling took {row['seconds']:.0f}s ({row['cpuSeconds']:.0f}s CPU), read {row['readMB']:.0f}MB "
+          f"and wrote {row['writtenMB']:.0f}MB (see `tmp/xyz-report.csv`)")
 
     print('🎉 XYZ tiles have been created. All files are in the `output` directory, ready to be ingested into Atlascope!')
 
     return
 
+#########################################
+#####                               #####
+#####   `runPipeline` streams each  #####
+#####    plate through download,    #####
+#####     transform and warp        #####
+#####                               #####
+#########################################
+
+def runPipeline(identifier):
+
+    # each plate moves on as soon as its own inputs are ready;
+    # bounded queues between stages keep a fast stage from
+    # running far ahead, so network, Node and GDAL work overlap
+
+    gdal.UseExceptions()
+    start, started = time.monotonic(), time.time()
+    engine = createEngine()
+    items = downloadAnnotations(engine, identifier)
+    images = collectImages(items)
+    createTileset(engine)
+
+    transformQueue = queue.Queue(maxsize=args.queueSize)
+    warpQueue = queue.Queue(maxsize=args.queueSize)
+    invalid = []
+    invalidIDs = []
+    failed = []
+    rows = []
+    lock = threading.Lock()
+
+    def fail(name, stage, e):
+        print(f'‼️   {stage} failed for {name}: {e}')
+        with lock:
+            failed.append((name, stage, repr(e)))
+
+    def download(imgID):
+        imgManifest, mapIds = images[imgID]
+        try:
+            downloadSource(engine, imgID, imgManifest, mapIds)
+        except Exception as e:
+            fail(imgID, 'download', e)
+            return
+        for mapId in mapIds:
+            transformQueue.put(mapId)
+
+    def transform():
+        while (mapId := transformQueue.get()) is not None:
+            try:
+                mask, link = transformMask(engine, mapId+'.json')
+                if mask:
+                    failedIDs, links = checkMasks(engine, [mask])
+                    link = links[0] if links else None
+            except Exception as e:
+                fail(mapId, 'transform', e)
+                continue
+            if link:
+                with lock:
+                    invalid.append(link)
+                    invalidIDs.append(mapId)
+            elif mask:
+                warpQueue.put(mapId)
+
+    def warp():
+        while (mapId := warpQueue.get()) is not None:
+            try:
+                row = warpPlate(mapId+'.json', measure=False)
+            except Exception as e:
+                fail(mapId, 'warp', e)
+                continue
+            with lock:
+                rows.append(row)
+
+    # the warp threads share one process and so one block cache:
+    # it gets the whole budget's cache, each warp its own buffer
+
+    initWarpWorker(None, memoryShare(1)[0], memoryShare(args.warpWorkers)[1])
+    transformers = [threading.Thread(target=transform) for i in range(args.transformWorkers)]
+    warpers = [threading.Thread(target=warp) for i in range(args.warpWorkers)]
+    for t in transformers + warpers:
+        t.start()
+
+    print(f"Streaming {len(items)} plates from {len(images)} images through download → transform → warp...")
+    engine.map(download, images)
+
+    # drain the queues stage by stage
+
+    for t in transformers:
+        transformQueue.put(None)
+    for t in transformers:
+        t.join()
+    for t in warpers:
+        warpQueue.put(None)
+    for t in warpers:
+        t.join()
+
+    engine.printCacheStats()
+    writeWarpReport(rows)
+    reportArtifacts(started)
+    print(f"⏱️  Download, transform and warp took {time.monotonic() - start:.0f}s")
+
+    if failed:
+        print(" ")
+        for name, stage, error in failed:
+            print(f"‼️   {stage} failed for {name}: {error}")
+        print("‼️   Rerun the `pipeline` step once these are fixed; finished plates will be skipped.")
+    if invalid:
+        reportInvalidMasks(invalid, invalidIDs)
+    if failed or invalid:
+        return
+
+    print("✅   All plates transformed and warped!\n")
+    if mergePlates():
+        mosaicPlates()
+
 #########################################
 #####                               #####
 #####  `createDirectoryStructure`   #####
@@ -456,5 +3379,11 @@ if __name__ == "__main__":
         mosaicPlates()
     elif args.step =='create-xyz':
         createXYZ()
+    elif args.step == 'pipeline':
+        runPipeline(args.identifier)
+    elif args.step == 'verify-transform':
+        verifyTransform()
+    elif args.step == 'benchmark-dissolve':
+        benchmarkDissolve()
     else:
         print("ERROR: Step not recognized")
\ No newline at end of file
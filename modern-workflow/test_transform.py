@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+# compare the native transform engine against `allmaps transform
+# resource-mask` output recorded in `fixtures/transform/`; run with
+# `python -m pytest` from this directory. the references are recorded
+# by the CLI (see README), so the test waits until they are
+
+import os
+import sys
+import pytest
+
+pytest.importorskip('osgeo')
+
+# the script parses its arguments on import,
+# so give it none and get the defaults
+
+sys.argv = ['atlascopify.py']
+import atlascopify
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'transform')
+
+@pytest.mark.parametrize('mapId', ['polynomial', 'thin-plate-spline'])
+def test_matches_cli(mapId):
+    reference = os.path.join(FIXTURES, mapId+'-transformed.geojson')
+    if not os.path.isfile(reference) or not os.path.isfile(os.path.join(FIXTURES, 'allmaps-cli-version.txt')):
+        pytest.skip(f'no recorded CLI output for {mapId}, record it with `verify-transform --reference-dir fixtures/transform/`')
+    annotation = atlascopify.readJSONFile(os.path.join(FIXTURES, mapId+'.json'))
+    record = atlascopify.PlateRecord.fromAnnotation(mapId, annotation)
+    ring, = atlascopify.transformAnnotations([record])
+    distance = atlascopify.maskDistance(ring, reference)
+    assert distance <= atlascopify.args.transformTolerance
+
+def test_cli_options_follow_the_native_ones(monkeypatch):
+    monkeypatch.setattr(atlascopify.args, 'transformationType', 'polynomial')
+    monkeypatch.setattr(atlascopify.args, 'polynomialOrder', 2)
+    monkeypatch.setattr(atlascopify.args, 'maxOffsetRatio', 0.01)
+    monkeypatch.setattr(atlascopify.args, 'maxDepth', 3)
+    assert atlascopify.allmapsTransformOptions() == [
+        '--transformation-type', 'polynomial', '--polynomial-order', '2',
+        '--max-offset-ratio', '0.01', '--max-depth', '3']